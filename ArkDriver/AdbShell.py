@@ -0,0 +1,96 @@
+from threading import Lock
+from shlex import quote
+from .Logging import WARN
+
+class ShellCommandError(Exception):
+    def __init__(self, line, status, output):
+        super().__init__("'{}' exited with status {}: {}".format(line, status, output.strip()))
+        self.status = status
+        self.output = output
+
+class AdbShell(object):
+    _shells = {}
+    _shells_lock = Lock()
+
+    # One shared session per device serial
+    @classmethod
+    def for_device(cls, dev):
+        with cls._shells_lock:
+            if dev.serial not in cls._shells:
+                cls._shells[dev.serial] = cls(dev)
+            return cls._shells[dev.serial]
+
+    def __init__(self, dev):
+        self._dev = dev
+        self._conn = None
+        self._lock = Lock()
+        self._seq = 0
+        self._buffer = b''
+
+    def open(self):
+        self.close()
+        self._conn = self._dev.open_transport()
+        self._conn.send_command("shell:sh")
+        self._conn.check_okay()
+        self._buffer = b''
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+
+    def _read_until(self, marker):
+        while marker not in self._buffer:
+            chunk = self._conn.conn.recv(4096)
+            if not chunk:
+                raise ConnectionError("adb shell session closed")
+            self._buffer += chunk
+        output, _, self._buffer = self._buffer.partition(marker)
+        # The exit status and newline follow the marker
+        while b'\n' not in self._buffer:
+            chunk = self._conn.conn.recv(4096)
+            if not chunk:
+                raise ConnectionError("adb shell session closed")
+            self._buffer += chunk
+        status, _, self._buffer = self._buffer.partition(b'\n')
+        return output, int(status)
+
+    def _send(self, line):
+        self._seq += 1
+        marker = "__ARK_END_{}__".format(self._seq)
+        self._conn.send((line + "; echo {}$?\n".format(marker)).encode("utf-8"))
+        output, status = self._read_until(marker.encode("utf-8"))
+        return (output.decode("utf-8", errors="ignore"), status)
+
+    # -> output of line, raises ShellCommandError when it exits with a non-zero status
+    def run_line(self, line):
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._conn is None:
+                        self.open()
+                    output, status = self._send(line)
+                    break
+                except Exception as e:
+                    if attempt:
+                        raise
+                    WARN("Exception in adb shell session:", e, ",Reopening")
+                    self.close()
+        if status != 0:
+            raise ShellCommandError(line, status, output)
+        return output
+
+    def run(self, cmdargs):
+        if isinstance(cmdargs, str):
+            return self.run_line(cmdargs)
+        return self.run_line(" ".join(quote(str(arg)) for arg in cmdargs))
+
+    # Sends all commands in a single round trip, optionally pausing between them on the device.
+    # The batch stops at the first command that fails.
+    def run_batch(self, cmds, interval=None):
+        lines = [cmd if isinstance(cmd, str) else " ".join(quote(str(arg)) for arg in cmd) for cmd in cmds]
+        sep = " && sleep {} && ".format(interval) if interval else " && "
+        return self.run_line(sep.join(lines))
@@ -1,8 +1,19 @@
-from time import sleep
+from time import sleep, time
+from threading import Thread, Condition, Lock
+from contextlib import contextmanager
 from adbutils import adb
 from io import BytesIO
 from PIL import Image
+import numpy as np
+import struct
 from .Logging import WARN
+from .AdbShell import AdbShell
+from .Frame import Frame
+
+# screencap pixel formats (android.graphics.PixelFormat)
+RAW_RGBA_8888 = 1
+RAW_RGBX_8888 = 2
+RAW_BGRA_8888 = 5
 
 class AndroidDev(object):
     def __init__(self, serial=None):
@@ -10,37 +21,115 @@ class AndroidDev(object):
             self._dev = adb.device(serial=serial)
         else:
             self._dev = adb.device()
+        self.shell = AdbShell.for_device(self._dev)
         self._screenshot_retry_wait = 1.0
         self._screenshot_on_dev_path = "/sdcard/screen.png"
-        self._screen = None
+        # Captures through the file on the device, from the pipeline and directly, take turns
+        self._png_lock = Lock()
+        self._capture_mode = "raw"
+        self._frame = None
+        self._last_input_time = 0
         self._geometry = None
+        self._pipeline = None
+        self._pipeline_running = False
+        self._pipeline_interval = 0.2
+        self._pipeline_paused = False
+        self._pipeline_timeout = 5.0
+        self._frame_cond = Condition()
+        self._latest_frame = None
 
     
     def tap(self, x, y):
-        self._dev.shell(["input", "tap", str(x), str(y)])
+        self.shell.run(["input", "tap", x, y])
+        self._last_input_time = time()
 
     def swipe(self, x, y, dx, dy, t):
-        self._dev.shell(["input", "swipe", str(x), str(y), str(x + dx), str(y + dy), str(t)])
+        self.shell.run(["input", "swipe", x, y, x + dx, y + dy, t])
+        self._last_input_time = time()
+
+    def tap_chain(self, points, interval=1.0):
+        self.shell.run_batch([["input", "tap", x, y] for x, y in points], interval)
+        self._last_input_time = time()
 
     def set_screenshot_retry_wait(self, time):
         self._screenshot_retry_wait = time
     
     def set_screenshot_on_dev_path(self, path):
         self._screenshot_on_dev_path = path
+
+    # "raw": stream the framebuffer over exec-out, "png": screencap -p to a file and pull it
+    def set_capture_mode(self, mode):
+        assert mode in ("raw", "png")
+        self._capture_mode = mode
     
+    def get_frame(self):
+        return self._frame
+
     def get_screen(self):
-        return self._screen
+        return self._frame.to_pil() if self._frame else None
+
+    def get_screen_array(self):
+        return self._frame.array if self._frame else None
     
     def get_geometry(self):
         if not self._geometry:
-            size_str = self._dev.shell(["wm", "size"])
+            size_str = self.shell.run(["wm", "size"])
             self._geometry = tuple(map(int, size_str.partition(":")[2].strip().split("x")))
         return self._geometry
 
+    def exec_out(self, cmdargs):
+        conn = self._dev.open_transport()
+        try:
+            conn.send_command("exec:" + " ".join(cmdargs))
+            conn.check_okay()
+            chunks = []
+            while True:
+                chunk = conn.conn.recv(1 << 20)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks)
+        finally:
+            conn.close()
+
+    def decode_raw_screen(self, data):
+        if len(data) < 12:
+            raise ValueError("Raw screencap of {} bytes has no header".format(len(data)))
+        w, h, fmt = struct.unpack_from("<III", data)
+        # Android 9+ appends a colorspace field to the header
+        header_size = len(data) - w * h * 4
+        if header_size not in (12, 16):
+            raise ValueError("Unexpected raw screencap size {} for {}x{}".format(len(data), w, h))
+        if fmt not in (RAW_RGBA_8888, RAW_RGBX_8888, RAW_BGRA_8888):
+            raise ValueError("Unsupported raw screencap format {}".format(fmt))
+        pixels = np.frombuffer(data, np.uint8, w * h * 4, header_size).reshape(h, w, 4)
+        if fmt == RAW_BGRA_8888:
+            pixels = pixels[..., [2, 1, 0, 3]]
+        if fmt == RAW_RGBX_8888:
+            pixels = pixels.copy()
+            pixels[..., 3] = 255
+        return pixels
+
+    def capture_raw(self):
+        while True:
+            try:
+                data = self.exec_out(["screencap"])
+            except Exception as e:
+                WARN("Exception when capturing raw screen:", e, ",Retrying")
+                sleep(self._screenshot_retry_wait)
+                continue
+            try:
+                array = self.decode_raw_screen(data)
+            except ValueError as e:
+                WARN("Raw capture unusable:", e, ",Falling back to png capture")
+                self._capture_mode = "png"
+                return None
+            return array
+
     def take_screen(self):
         while True:
             try:
-                self._dev.shell(["screencap", "-p", self._screenshot_on_dev_path])
+                self.shell.run(["screencap", "-p", self._screenshot_on_dev_path])
                 return
             except Exception as e:
                 WARN("Exception when taking screenshot:", e, ",Retrying")
@@ -50,16 +139,96 @@ class AndroidDev(object):
         while True:
             try:
                 binary_data = b''.join(self._dev.sync.iter_content(self._screenshot_on_dev_path))
-                self._screen = Image.open(BytesIO(binary_data))
-                return
+                return np.array(Image.open(BytesIO(binary_data)).convert("RGBA"))
             except Exception as e:
                 WARN("Exception when pulling screenshot:", e, ",Retrying")
                 sleep(self._screenshot_retry_wait)
-    
-    def refresh_screen(self):
-        self.take_screen()
-        self.pull_screen()
-        return self._screen
-    
-    
 
+    # -> Frame stamped with the capture start time
+    def capture(self):
+        ts = time()
+        if self._capture_mode == "raw":
+            array = self.capture_raw()
+            if array is not None:
+                return Frame(array, ts)
+        with self._png_lock:
+            self.take_screen()
+            return Frame(self.pull_screen(), ts)
+
+    def start_capture_pipeline(self, interval=0.2):
+        if self._pipeline is not None:
+            return
+        self._pipeline_interval = interval
+        self._pipeline_running = True
+        self._pipeline = Thread(target=self._pipeline_loop, daemon=True)
+        self._pipeline.start()
+
+    def stop_capture_pipeline(self):
+        if self._pipeline is None:
+            return
+        with self._frame_cond:
+            self._pipeline_running = False
+            self._frame_cond.notify_all()
+        self._pipeline.join()
+        self._pipeline = None
+
+    # A paused pipeline takes no captures, refresh_screen captures directly meanwhile
+    def pause_capture_pipeline(self):
+        with self._frame_cond:
+            self._pipeline_paused = True
+
+    def resume_capture_pipeline(self):
+        with self._frame_cond:
+            self._pipeline_paused = False
+            self._frame_cond.notify_all()
+
+    @contextmanager
+    def capture_paused(self):
+        paused = self._pipeline_paused
+        self.pause_capture_pipeline()
+        try:
+            yield
+        finally:
+            if not paused:
+                self.resume_capture_pipeline()
+
+    def is_capturing(self):
+        return self._pipeline is not None and not self._pipeline_paused
+
+    def _pipeline_loop(self):
+        while True:
+            with self._frame_cond:
+                self._frame_cond.wait_for(lambda: not self._pipeline_paused or not self._pipeline_running)
+                if not self._pipeline_running:
+                    return
+            try:
+                frame = self.capture()
+            except Exception as e:
+                WARN("Exception in capture pipeline:", e, ",Retrying")
+                sleep(self._screenshot_retry_wait)
+                continue
+            with self._frame_cond:
+                self._latest_frame = frame
+                self._frame_cond.notify_all()
+            wait = self._pipeline_interval - (time() - frame.ts)
+            if wait > 0:
+                sleep(wait)
+
+    def get_screen_time(self):
+        return self._frame.ts if self._frame else 0
+
+    # With the capture pipeline running, returns the latest frame captured after newer_than,
+    # which defaults to the later of the current frame and the last input sent to the device.
+    # Captures directly when the pipeline yields no such frame within _pipeline_timeout secs.
+    def refresh_screen(self, newer_than=None):
+        if self.is_capturing():
+            if newer_than is None:
+                newer_than = max(self.get_screen_time() + 1e-6, self._last_input_time)
+            with self._frame_cond:
+                if self._frame_cond.wait_for(lambda: self._latest_frame is not None and self._latest_frame.ts >= newer_than,
+                        self._pipeline_timeout):
+                    self._frame = self._latest_frame
+                    return self._frame
+            WARN("No frame from capture pipeline in", self._pipeline_timeout, "secs, Capturing directly")
+        self._frame = self.capture()
+        return self._frame
@@ -0,0 +1,37 @@
+# Recent battle durations kept per map
+BATTLE_HISTORY = 20
+
+# Battle durations per map, learned into stats["battle_durations"], to check for the end of a
+# battle when it is due rather than at a fixed pace
+class BattleTimer(object):
+    def __init__(self, stats):
+        self.durations = stats.setdefault("battle_durations", {})
+
+    def record(self, map_name, secs):
+        history = self.durations.setdefault(map_name, [])
+        history.append(secs)
+        del history[:-BATTLE_HISTORY]
+
+    # -> (shortest, 90th percentile) of the recent durations in secs, None without history
+    def window(self, map_name):
+        history = sorted(self.durations.get(map_name, []))
+        if not history:
+            return None
+        return (history[0], history[int(0.9 * (len(history) - 1))])
+
+    # -> elapsed secs -> secs until the next check. Checks halve the time left to the expected
+    # finish window, no closer than sparse secs apart, run every dense secs through the window,
+    # then every sparse secs once it has passed.
+    def schedule(self, map_name, sparse=30, dense=5):
+        window = self.window(map_name)
+        if window is None:
+            return lambda elapsed: sparse
+        lead = 2 * dense
+        start, end = window[0] - lead, window[1] + lead
+        def interval(elapsed):
+            if elapsed < start:
+                return min(start - elapsed, max((start - elapsed) / 2, sparse))
+            if elapsed < end:
+                return dense
+            return sparse
+        return interval
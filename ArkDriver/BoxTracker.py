@@ -0,0 +1,68 @@
+# Follows the boxes of a detection from frame to frame. Each box is looked for again only in a
+# window around where it moved to, and new boxes only in the bands of the crop the motion revealed.
+# The whole crop is detected again when a box is not found exactly once in its window, when
+# there is nothing to track, and every refresh frames to pick up boxes appearing in place.
+class BoxTracker(object):
+    def __init__(self, margin=16, refresh=10):
+        self.margin = margin
+        self.refresh = refresh
+        self.boxes = None
+        self.count = 0
+
+    def reset(self):
+        self.boxes = None
+
+    # detect: (x0, y0, x1, y1) window -> [(x, y, w, h) boxes] in it, full: () -> boxes in the whole crop
+    # motion: (dx, dy) the content moved by since the last frame
+    # map_fn: (detect, [windows]) -> [results of detect] in window order
+    # -> boxes in crop
+    def track(self, detect, full, crop, motion=(0, 0), map_fn=lambda fn, items: list(map(fn, items))):
+        if not self.boxes or self.count >= self.refresh:
+            return self.detect_all(full)
+        m = self.margin
+        mx, my = motion
+        cx0, cy0, cx1, cy1 = crop
+        windows = []
+        for x, y, w, h in self.boxes:
+            x, y = round(x + mx), round(y + my)
+            # Moved out of the crop
+            if x < cx0 or y < cy0 or x + w > cx1 or y + h > cy1:
+                continue
+            windows.append(self.clip((x - m, y - m, x + w + m, y + h + m), crop))
+        bands = self.revealed(crop, motion)
+        results = map_fn(detect, windows + bands)
+        found = []
+        for local in results[:len(windows)]:
+            if len(local) != 1:
+                return self.detect_all(full)
+            found += local
+        for band_boxes in results[len(windows):]:
+            found += [b for b in band_boxes if not any(abs(b[0] - f[0]) <= m and abs(b[1] - f[1]) <= m for f in found)]
+        self.boxes = found
+        self.count += 1
+        return found
+
+    def detect_all(self, full):
+        self.boxes = list(full())
+        self.count = 0
+        return self.boxes
+
+    def clip(self, window, crop):
+        return (max(window[0], crop[0]), max(window[1], crop[1]), min(window[2], crop[2]), min(window[3], crop[3]))
+
+    # -> windows along the edges of crop the content moved away from, wide enough for whole boxes
+    def revealed(self, crop, motion):
+        mx, my = round(motion[0]), round(motion[1])
+        cx0, cy0, cx1, cy1 = crop
+        bw = max(w for _, _, w, _ in self.boxes) + self.margin
+        bh = max(h for _, _, _, h in self.boxes) + self.margin
+        bands = []
+        if mx < 0:
+            bands.append(self.clip((cx1 + mx - bw, cy0, cx1, cy1), crop))
+        elif mx > 0:
+            bands.append(self.clip((cx0, cy0, cx0 + mx + bw, cy1), crop))
+        if my < 0:
+            bands.append(self.clip((cx0, cy1 + my - bh, cx1, cy1), crop))
+        elif my > 0:
+            bands.append(self.clip((cx0, cy0, cx1, cy0 + my + bh), crop))
+        return bands
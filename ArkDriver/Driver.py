@@ -1,8 +1,21 @@
 from .AndroidDev import AndroidDev
 from .cvUtils import *
+from .RefStore import RefStore
+from .Glyphs import build_glyph_data
+from .StateClassifier import StateClassifier
+from .RecognitionPlan import RecognitionPlan, ocr_key, binary_key, prep_key, box_key
+from .RegionCache import RegionHasher, RegionCache
+from .Navigator import Navigator
+from .ScrollIndex import ScrollIndex, jump_swipes
+from .BoxTracker import BoxTracker
+from .BattleTimer import BattleTimer
+from .Logging import WARN
 from pprint import pprint
-from time import sleep
+from time import sleep, time, perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
 import yaml, pickle
+import os
 import cv2
 
 class ArkDriver(object):
@@ -12,18 +25,57 @@ class ArkDriver(object):
         else:
             self._dev = AndroidDev()
         self.config = {"geometry": self._dev.get_geometry(), "components":{}, "boxes": {}, "query_sets": {}, "searches": {}}
-        self.geometry = self._dev.get_geometry()
-        self.ref_data = {"components":{}, "queries": {}, "subimages":{}}
-        self.component_validation_cache = {}
-        self.box_cache = {}
-        self.query_set_cache = {}
+        self.geometry = self.config["geometry"]
+        self.scale = 1.0
+        self.device_size = None
+        self.frame = None
+        self.ref_data = {"components":{}, "queries": {}, "subimages":{}, "glyphs": {}}
+        self.refs = RefStore(self.ref_data)
+        self.classifier = StateClassifier(self.config["components"])
+        self.plan = RecognitionPlan(self.config, self.refs)
+        self.stats = {}
+        self.stats_fn = None
+        self.navigator = Navigator(None, self.stats)
+        self.battle_timer = BattleTimer(self.stats)
+        self.use_fingerprints = True
+        # Read the OCR queries of a query set in one tesseract run per lang and config when
+        # falling back to pytesseract
+        self.batch_ocr = True
+        self.region_hash = RegionHasher(self.scale_crop)
+        self.component_validation_cache = RegionCache(self.region_hash)
+        self.box_cache = RegionCache(self.region_hash)
+        self.query_set_cache = RegionCache(self.region_hash)
+        self.step_cache = RegionCache(self.region_hash)
+        self.box_trackers = {}
+        self.swipe_count = 0
+        self.step_locks = {}
+        self.step_locks_lock = Lock()
+        self.pool = None
+        self._local = local()
         self.last_log = {}
 
-    def load_from_file(self, config_fn="config.yaml", ref_data_fn="ref.data"):
+    # stats_fn: file of measurements learned across runs, created on first save
+    def load_from_file(self, config_fn="config.yaml", ref_data_fn="ref.data", stats_fn="stats.data"):
         with open(config_fn) as f:
             self.config = yaml.load(f, Loader=yaml.CLoader)
+        self.geometry = tuple(self.config["geometry"])
+        self.scale = self.config.get("recognition_scale", 1.0)
+        self.classifier = StateClassifier(self.config["components"])
         with open(ref_data_fn, "rb") as f:
             self.ref_data = pickle.load(f)
+        self.ref_data.setdefault("glyphs", {})
+        self.refs = RefStore(self.ref_data, self.scale)
+        self.refs.compile_all()
+        self.plan = RecognitionPlan(self.config, self.refs)
+        self.clear_caches()
+        self.set_workers(self.config.get("workers", 1))
+        self.stats_fn = stats_fn
+        self.stats = {}
+        if stats_fn and os.path.exists(stats_fn):
+            with open(stats_fn, "rb") as f:
+                self.stats = pickle.load(f)
+        self.navigator = Navigator(self.config.get("navigation", None), self.stats)
+        self.battle_timer = BattleTimer(self.stats)
     
     def save_to_file(self, config_fn="config.yaml", ref_data_fn="ref.data"):
         with open(config_fn, "w") as f:
@@ -31,33 +83,212 @@ class ArkDriver(object):
         with open(ref_data_fn, "wb") as f:
             pickle.dump(self.ref_data, f)
 
+    # Recognition work of a frame, query sets, box windows, deps and OCR batches, is spread over
+    # a pool of worker threads, 1 for none
+    def set_workers(self, workers):
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="ArkDriver") if workers > 1 else None
+
+    # Logs of the thread calling, a worker's log reaches the caller through map_parallel
+    @property
+    def last_log(self):
+        return getattr(self._local, "last_log", {})
+
+    @last_log.setter
+    def last_log(self, log):
+        self._local.last_log = log
+
+    def use_pool(self, items):
+        return self.pool is not None and len(items) > 1 and not getattr(self._local, "worker", False)
+
+    def run_task(self, fn, item):
+        self._local.worker = True
+        self.last_log = None
+        try:
+            return (fn(item), self.last_log)
+        finally:
+            self._local.worker = False
+
+    # -> [(fn(item), last_log it left, None if it left none)] in item order, run on the pool
+    def run_parallel(self, fn, items):
+        return list(self.pool.map(lambda item: self.run_task(fn, item), items))
+
+    # -> [fn(item)] in item order, run on the pool when there is one, leaving last_log as running
+    # them in order would. Calls from a worker run in line, the pool never waits on itself.
+    def map_parallel(self, fn, items):
+        items = list(items)
+        if not self.use_pool(items):
+            return [fn(item) for item in items]
+        results = []
+        for result, log in self.run_parallel(fn, items):
+            if log is not None:
+                self.last_log = log
+            results.append(result)
+        return results
+
+    # Same result and last_log as validating the deps in order up to the first failure
+    def deps_valid(self, deps):
+        if not self.use_pool(deps):
+            return all(self.validate_component(dep) for dep in deps)
+        for valid, log in self.run_parallel(self.validate_component, deps):
+            if log is not None:
+                self.last_log = log
+            if not valid:
+                return False
+        return True
+
+    def save_stats(self):
+        if self.stats_fn:
+            with open(self.stats_fn, "wb") as f:
+                pickle.dump(self.stats, f)
+
     def set_component(self, name, component):
         self.config["components"][name] = component
+        self.refs.invalidate("fingerprints", name)
+        self.plan.invalidate(name)
+        self.clear_caches()
     
     def set_component_ref_data(self, name, data):
         self.ref_data["components"][name] = data
+        self.refs.invalidate("components", name)
+        self.refs.invalidate("fingerprints", name)
+        self.plan.invalidate(name)
+        self.clear_caches()
     
     def set_subimages_ref_data(self, name, data):
         self.ref_data["subimages"][name] = data
+        self.refs.invalidate("subimages", name)
+        self.clear_caches()
     
+    def set_glyphs_ref_data(self, name, data):
+        self.ref_data["glyphs"][name] = data
+        self.refs.invalidate("glyphs", name)
+        self.clear_caches()
+
+    # Recognition runs on the screen resized to geometry * scale, references are resized to match
+    def set_recognition_scale(self, scale):
+        self.config["recognition_scale"] = scale
+        self.scale = scale
+        self.refs.set_scale(scale)
+        if self.frame is not None:
+            self.refresh_screen()
+
     def set_box(self, name, box):
         self.config["boxes"][name] = box
+        self.clear_caches()
 
     def set_query_set(self, name, q_set):
         self.config["query_sets"][name] = q_set
+        self.clear_caches()
     
     def set_search(self, name, search):
         self.config["searches"][name] = search
     
-    def tap_refresh(self, x, y, delay=2.5):
-        self._dev.tap(x, y)
-        sleep(delay)
-        self.refresh_screen()
+    # Config coordinates (crops, shapes, taps, swipes) are relative to geometry
+    # -> device screen coordinates of point (x, y)
+    def to_device(self, x, y):
+        if self.device_size is None:
+            self.refresh_screen()
+        return (round(x * self.device_size[0] / self.geometry[0]),
+                round(y * self.device_size[1] / self.geometry[1]))
+
+    # (x0, y0, x1, y1) crop in config coordinates -> crop of the recognition screen
+    def scale_crop(self, crop):
+        x0, y0 = round(crop[0] * self.scale), round(crop[1] * self.scale)
+        return (x0, y0, x0 + round((crop[2] - crop[0]) * self.scale), y0 + round((crop[3] - crop[1]) * self.scale))
 
-    def swipe_refresh(self, x, y, dx, dy, t, delay=2.5):
-        self._dev.swipe(x, y, dx, dy, t)
-        sleep(delay)
-        self.refresh_screen()
+    # (x, y, w, h) box or shape between config and recognition screen coordinates
+    def scale_box(self, box):
+        return tuple(round(v * self.scale) for v in box)
+
+    def unscale_box(self, box):
+        return tuple(round(v / self.scale) for v in box)
+
+    # Refreshes the screen until it stops changing for window secs and until() holds, or until
+    # timeout secs have passed. Frames count as unchanged when their downsampled gray difference
+    # stays within max_diff. The first min_wait secs are skipped to let the UI react to the input.
+    # -> True if the screen settled before the timeout
+    def wait_stable(self, timeout, until=None, min_wait=0.5, window=0.6, max_diff=2.0):
+        deadline = time() + timeout
+        sleep(min(min_wait, timeout))
+        last = None
+        stable_since = None
+        while True:
+            frame = self.refresh_screen()
+            if last is not None and frame.difference(last) <= max_diff:
+                if stable_since is None:
+                    stable_since = last.ts
+                if frame.ts - stable_since >= window and (until is None or until()):
+                    return True
+            else:
+                stable_since = None
+            last = frame
+            if time() >= deadline:
+                return False
+
+    # Polls until targets are reached or timeout secs have passed (None: no limit).
+    # targets: component names, reached when any of them matches, or a predicate, reached when it returns a truthy value.
+    # The check interval starts at min_interval and doubles up to max_interval while the watched pixels stay
+    # the same, any change resets it. Watched are the crops of the watch components, by default the target
+    # components, or the whole screen for a predicate. With the capture pipeline running, the frames between
+    # checks up to max_peek secs apart are compared on the watched pixels only and a change triggers the next
+    # check at once. Longer waits sleep with the pipeline paused.
+    # schedule: elapsed secs -> secs until the next check, replaces the doubling intervals
+    # -> (set of matched components or the predicate's value, None on timeout; elapsed secs)
+    def wait_for(self, targets, timeout=None, min_interval=0.2, max_interval=30, watch=None, max_diff=2.0, schedule=None, max_peek=2.0):
+        start = time()
+        if callable(targets):
+            check = targets
+        else:
+            names = list(targets)
+            check = lambda: self.classify(names, first=True)
+            if watch is None:
+                watch = names
+        if watch is None:
+            signature = lambda: self.frame
+            changed = lambda a, b: a.difference(b) > max_diff
+        else:
+            signature = lambda: tuple(self.region_hash(self.config["components"][name]["crop"])
+                for name in watch if name in self.config["components"])
+            changed = lambda a, b: a != b
+        interval = min_interval
+        last = None
+        while True:
+            self.refresh_screen()
+            result = check()
+            elapsed = time() - start
+            if result:
+                return (result, elapsed)
+            if timeout is not None and elapsed >= timeout:
+                return (None, elapsed)
+            current = signature()
+            if last is not None and changed(current, last):
+                interval = min_interval
+            last = current
+            wake = time() + (schedule(elapsed) if schedule else interval)
+            if timeout is not None:
+                wake = min(wake, start + timeout)
+            interval = min(interval * 2, max_interval)
+            if not self._dev.is_capturing() or wake - time() > max_peek:
+                with self._dev.capture_paused():
+                    sleep(max(wake - time(), 0))
+                continue
+            while time() < wake:
+                self.refresh_screen()
+                if changed(signature(), last):
+                    interval = min_interval
+                    break
+
+    def tap_refresh(self, x, y, delay=2.5, until=None):
+        self._dev.tap(*self.to_device(x, y))
+        return self.wait_stable(delay, until)
+
+    def swipe_refresh(self, x, y, dx, dy, t, delay=2.5, until=None):
+        self._dev.swipe(*self.to_device(x, y), *self.to_device(dx, dy), t)
+        self.swipe_count += 1
+        # input swipe returns once the gesture has ended, only the list's own scrolling is left to settle
+        return self.wait_stable(delay, until)
 
     def print_last_log(self, last_log=None, show_img=True):
         if last_log is None:
@@ -66,7 +297,7 @@ class ArkDriver(object):
         pprint(log)
         if show_img:
             for name, img in [(k,v) for k,v in last_log.items() if k.endswith("_img")]:
-                img.show(title=name)
+                to_pil(img).show(title=name)
     
     def dump_last_log(self, last_log=None):
         if last_log is None:
@@ -77,11 +308,83 @@ class ArkDriver(object):
         self.component_validation_cache.clear()
         self.box_cache.clear()
         self.query_set_cache.clear()
+        self.step_cache.clear()
+        self.box_trackers = {}
     
-    def refresh_screen(self):
-        self.clear_caches()
-        return self._dev.refresh_screen()
-    
+    # Cached results survive the refresh when the regions they were computed from are unchanged
+    def refresh_screen(self, newer_than=None):
+        frame = self._dev.refresh_screen(newer_than)
+        device_size = frame.size
+        if device_size != self.device_size:
+            self.device_size = device_size
+            if abs(device_size[0] * self.geometry[1] - device_size[1] * self.geometry[0]) > self.geometry[0]:
+                WARN("Screen size", device_size, "does not match the aspect ratio of the config geometry", self.geometry)
+        size = (round(self.geometry[0] * self.scale), round(self.geometry[1] * self.scale))
+        last_size = self.frame.size if self.frame else None
+        self.frame = frame if device_size == size else frame.resize(size)
+        self.region_hash.set_frame(self.frame)
+        self.step_locks = {}
+        if self.frame.size != last_size:
+            self.clear_caches()
+        for cache in (self.component_validation_cache, self.box_cache, self.query_set_cache, self.step_cache):
+            cache.refresh()
+        return self.frame
+
+    # Frame as recognition sees it, at geometry * scale
+    def get_frame(self):
+        if self.frame is None:
+            self.refresh_screen()
+        return self.frame
+
+    def get_screen(self):
+        return self.get_frame().to_pil()
+
+    # Screen at config geometry, for capturing references
+    def reference_screen(self):
+        frame = self._dev.get_frame()
+        if frame.size != tuple(self.geometry):
+            frame = frame.resize(tuple(self.geometry))
+        return frame.to_pil()
+
+    # -> read-only view of the crop in BGR, or luma with plane="luma"
+    def crop_screen_cv(self, crop, plane="bgr"):
+        return self.get_frame().crop(self.scale_crop(crop), plane)
+
+    # Result of a plan step, computed once for as long as the pixels of region do not change.
+    # Step keys of crop checks carry their crop as region.
+    # Workers needing the same step wait for the one computing it.
+    def run_step(self, key, compute, region=None):
+        if key not in self.step_cache:
+            with self.step_locks_lock:
+                lock = self.step_locks.setdefault(key, Lock())
+            with lock:
+                if key not in self.step_cache:
+                    self.get_frame()
+                    self.step_cache.store(key, compute(), [region or key[1]])
+        return self.step_cache[key]
+
+    def preprocess_crop(self, crop, mask=None, threshold=None, canny_args=None):
+        # Unmasked crops are binarized straight from the frame's luma plane
+        plane = "luma" if threshold and mask is None else "bgr"
+        return preprocess_cv(self.crop_screen_cv(crop, plane), mask, threshold, canny_args)
+
+    # Crop preprocessed the way the component's check sees it
+    def component_crop(self, name):
+        config = self.config["components"][name]
+        key = self.plan.component_steps(name)[0]
+        if config["type"] == "ssim":
+            return self.run_step(key, lambda: self.preprocess_crop(config["crop"], self.refs.component(name)[1],
+                config.get("threshold", None),
+                config.get("canny_args", None)))
+        if config["type"] == "ocr":
+            return self.run_step(key, lambda: ocr_binary(self.crop_screen_cv(config["crop"], "luma"), config["threshold"]))
+
+    def fingerprint_rejects(self, name, cropped):
+        if not self.use_fingerprints:
+            return False
+        fingerprint = self.refs.fingerprint(name, self.config["components"][name])
+        return fingerprint is not None and not fingerprint.accepts(cropped)
+
     def validate_component(self, name):
         if name in self.component_validation_cache:
             return self.component_validation_cache[name] 
@@ -90,20 +393,14 @@ class ArkDriver(object):
         config = self.config["components"][name]
         
         if config["type"] == "ssim":
-            ref = bytes_to_pil(self.ref_data["components"][name])
-            ref, mask = extract_alpha(ref)
-
-            cropped = self._dev.get_screen().crop(config["crop"])
-            cropped, _ = extract_alpha(cropped)
-            if mask:
-                cropped = Image.composite(cropped, Image.new(cropped.mode, cropped.size), mask)
-                ref = Image.composite(ref, Image.new(ref.mode, ref.size), mask)
-            if config.get("threshold", None):
-                cropped = binarize(cropped, config["threshold"])
-            if config.get("canny_args", None):
-                cropped = canny(cropped, *config["canny_args"])
-            conf = ssim(cropped, ref)
-            result = conf >= config["min_conf"]
+            ref, mask, ref_stats = self.refs.component(name)
+            cropped = self.component_crop(name)
+            if self.fingerprint_rejects(name, cropped):
+                conf = None
+                result = False
+            else:
+                conf = ssim_stats_cv(cropped, ref_stats)
+                result = conf >= config["min_conf"]
 
             self.last_log = {
                 "name": name,
@@ -111,19 +408,18 @@ class ArkDriver(object):
                 "conf": conf,
                 "src_img": cropped,
                 "ref_img": ref,
-                "screen_img": self._dev.get_screen()
+                "screen_img": self.frame
             }
 
-            if result:
-                self.component_validation_cache[name] = True
-                return True
-            else:
-                self.component_validation_cache[name] = False
-                return False
+            return self.component_validation_cache.store(name, result, [config["crop"]])
         
         if config["type"] == "ocr":
-            cropped = self._dev.get_screen().crop(config["crop"])
-            text = ocr_text(cropped, config["threshold"], config["lang"], config["config"])
+            cropped = self.component_crop(name)
+            if self.fingerprint_rejects(name, cropped):
+                text = None
+            else:
+                text = self.run_step(self.plan.component_steps(name)[1],
+                    lambda: ocr_binary_text(cropped, config["lang"], config["config"]))
             result = text == config["text"]
 
             self.last_log = {
@@ -132,44 +428,114 @@ class ArkDriver(object):
                 "src_img": cropped,
                 "src_text": text,
                 "ref_text": config["text"],
-                "screen_img": self._dev.get_screen()
+                "screen_img": self.frame
             }
 
-            if result:
-                self.component_validation_cache[name] = True
-                return True
-            else:
-                self.component_validation_cache[name] = False
-                return False
+            return self.component_validation_cache.store(name, result, [config["crop"]])
     
-    def tap_refresh_component(self, name, delay=2.5):
+    # -> set of matching components among names (all components if None), with
+    # the cheapest checks run first. first: stop at the first match.
+    def classify(self, names=None, first=False):
+        if names is None:
+            names = list(self.config["components"])
+        matched = set()
+        for group in self.classifier.cascade(names, first):
+            fresh = [name for name in group if name not in self.component_validation_cache]
+            start = perf_counter()
+            matched.update(name for name in group if self.validate_component(name))
+            if fresh:
+                self.classifier.record(fresh, perf_counter() - start, matched)
+            if first and matched:
+                break
+        return matched
+
+    def component_tap_position(self, name):
+        config = self.config["components"][name]
+        return (config["crop"][0] + config["tap_offset"][0],
+                config["crop"][1] + config["tap_offset"][1])
+
+    # Taps the component if it is on screen, without waiting for the result
+    def tap_component(self, name):
         if not self.validate_component(name):
             return False
-        config = self.config["components"][name]
+        self._dev.tap(*self.to_device(*self.component_tap_position(name)))
+        return True
+
+    # Only the first component is validated, the rest are tapped blindly in the same shell batch
+    def tap_component_chain(self, names, interval=1.0):
+        if not self.validate_component(names[0]):
+            return False
+        points = [self.to_device(*self.component_tap_position(name)) for name in names]
+        if len(points) == 1:
+            self._dev.tap(*points[0])
+        else:
+            self._dev.tap_chain(points, interval)
+        return True
 
-        tap_position = (config["crop"][0] + config["tap_offset"][0],
-                        config["crop"][1] + config["tap_offset"][1])
-        self.tap_refresh(*tap_position, delay)
+    # delay: the longest wait for the screen to settle after the tap
+    def tap_refresh_component(self, name, delay=2.5, until=None):
+        if not self.validate_component(name):
+            return False
+        self.tap_refresh(*self.component_tap_position(name), delay, until)
         return True
 
-    def find_box(self, name, draw=False):
+    # -> name of the navigation page on screen, None if no page is recognized
+    def locate_page(self):
+        return self.navigator.page_of(self.classify(self.navigator.components()))
+
+    # Follows the cheapest route of the navigation graph from the recognized page to page,
+    # replanning from wherever a transition lands when it does not reach the expected page.
+    # delay: the longest wait for each transition
+    def goto(self, page, delay=15, replans=3):
+        try:
+            for _ in range(replans + 1):
+                current = self.locate_page()
+                if current == page:
+                    return True
+                route = self.navigator.route(current, page) if current else None
+                if not route:
+                    return False
+                print("  Route: {}".format(" -> ".join([current] + [dst for _, dst, _ in route])))
+                for hops in self.navigator.chains(route):
+                    if not self.tap_component_chain([tap for _, _, tap in hops]):
+                        break
+                    reached, elapsed = self.wait_for([self.navigator.pages[hops[-1][1]]["component"]], delay)
+                    # A failed transition costs its wait and then some, so routes avoid it
+                    for src, dst, _ in hops:
+                        self.navigator.record(src, dst, (elapsed if reached else elapsed + delay) / len(hops))
+                    if not reached:
+                        break
+                else:
+                    return True
+            return False
+        finally:
+            self.save_stats()
+
+    # Boxes with track set are followed from the previous find_box call, see BoxTracker.
+    # motion: (dx, dy) the content moved by since then in config units. None if not known,
+    # the content is then taken as still, unless there was a swipe in between.
+    def find_box(self, name, draw=False, motion=None):
         if name in self.box_cache:
             return self.box_cache[name]
         if not name in self.config["boxes"]:
             return None
         config = self.config["boxes"][name]
 
-        for dep in config["deps"]:
-            if not self.validate_component(dep):
-                return None
+        if not self.deps_valid(config["deps"]):
+            return None
         if config["type"] == "float":
-            floats = find_floats(self._dev.get_screen(), config["crop"], config["shape"],
+            shape = self.scale_box(config["shape"])
+            kernel = max(round(config.get("kernel", 5) * self.scale), 1)
+            repeat = config.get("repeat", None)
+            detect = lambda crop: find_floats(self.get_frame(), crop, shape,
                 config.get("ref_color", None),
                 config.get("threshold", 150),
                 config.get("canny_args", None),
-                config.get("kernel", 5),
-                config.get("repeat", None))
-            drawn = draw_shapes(self._dev.get_screen(), floats)
+                kernel,
+                repeat and self.scale_box(repeat))
+            found = self.detect_boxes(name, config, detect, motion)
+            floats = [self.unscale_box(b) for b in found]
+            drawn = draw_shapes(self.get_frame(), found)
             if draw:
                 drawn.show()
             
@@ -177,15 +543,14 @@ class ArkDriver(object):
                 "name": name,
                 "result": floats,
                 "boxes_img": drawn,
-                "screen_img": self._dev.get_screen()
+                "screen_img": self.frame
             }
 
-            self.box_cache[name] = floats
-            return floats
+            return self.box_cache.store(name, floats, self.box_regions(name))
         
         if config["type"] == "fixed":
             rects = config["rects"]
-            drawn = draw_shapes(self._dev.get_screen(), rects)
+            drawn = draw_shapes(self.get_frame(), [self.scale_box(r) for r in rects])
             if draw:
                 drawn.show()
             
@@ -193,20 +558,24 @@ class ArkDriver(object):
                 "name": name,
                 "result": rects,
                 "boxes_img": drawn,
-                "screen_img": self._dev.get_screen()
+                "screen_img": self.frame
             }
 
-            self.box_cache[name] = rects
-            return rects
+            return self.box_cache.store(name, rects, self.box_regions(name))
         
         if config["type"] == "subimage":
-            subs = [bytes_to_pil(self.ref_data["subimages"][name]) for name in config["subimages"]]
-            boxes = match_sub_image(self._dev.get_screen(), subs, config["crop"],
+            subs = [self.refs.subimage(name) for name in config["subimages"]]
+            detect = lambda crop: match_sub_image(self.get_frame(), subs, crop,
                 config.get("method", cv2.TM_CCOEFF_NORMED),
                 config.get("match_th", 0.2),
                 config.get("ssim_th", 0.6),
-                config.get("weights", (1.0,1.0,1.0)))
-            drawn = draw_shapes(self._dev.get_screen(), boxes)
+                config.get("weights", (1.0,1.0,1.0)),
+                config.get("pyramid", 0),
+                config.get("refine", 4),
+                config.get("coarse_th", None))
+            found = self.detect_boxes(name, config, detect, motion)
+            boxes = [self.unscale_box(b) for b in found]
+            drawn = draw_shapes(self.get_frame(), found)
             if draw:
                 drawn.show()
             
@@ -214,12 +583,66 @@ class ArkDriver(object):
                 "name": name,
                 "result": boxes,
                 "boxes_img": drawn,
-                "screen_img": self._dev.get_screen()
+                "screen_img": self.frame
             }
 
-            self.box_cache[name] = boxes
-            return boxes
+            return self.box_cache.store(name, boxes, self.box_regions(name))
     
+    # detect: recognition screen crop -> boxes in it
+    # -> boxes of the box config on the recognition screen, tracked when it has track set
+    def detect_boxes(self, name, config, detect, motion):
+        crop = self.scale_crop(config["crop"])
+        full = lambda: self.run_step(box_key(config), lambda: detect(crop), config["crop"])
+        # Repeated boxes are extrapolated from a random one, there is nothing to track
+        if not config.get("track", False) or config.get("repeat", None):
+            return full()
+        tracker, swipe_count = self.box_trackers.get(name, (None, None))
+        if tracker is None:
+            tracker = BoxTracker(max(round(config.get("track_margin", 16) * self.scale), 1), config.get("track_refresh", 10))
+        if motion is None:
+            if swipe_count != self.swipe_count:
+                tracker.reset()
+            motion = (0, 0)
+        self.box_trackers[name] = (tracker, self.swipe_count)
+        return tracker.track(detect, full, crop, (motion[0] * self.scale, motion[1] * self.scale), self.map_parallel)
+
+    # Config regions whose pixels decide a box or query set, including those of their deps
+    def dep_regions(self, deps):
+        return [self.config["components"][dep]["crop"] for dep in deps]
+
+    def box_regions(self, name):
+        config = self.config["boxes"][name]
+        regions = self.dep_regions(config["deps"])
+        if config["type"] != "fixed":
+            regions.append(config["crop"])
+        return regions
+
+    def query_set_regions(self, name):
+        config = self.config["query_sets"][name]
+        regions = self.dep_regions(config["deps"])
+        crops = [q["crop"] for q in config["queries"] if "crop" in q]
+        if config["type"] == "fixed":
+            return regions + crops
+        # Float queries read crops offset by box positions, which lie within the box crop
+        box_config = self.config["boxes"][config["box"]]
+        regions += self.box_regions(config["box"])
+        if crops and box_config["type"] != "fixed":
+            x0, y0, x1, y1 = box_config["crop"]
+            regions.append((max(x0 + min(min(c[0] for c in crops), 0), 0),
+                            max(y0 + min(min(c[1] for c in crops), 0), 0),
+                            min(x1 + max(c[2] for c in crops), self.geometry[0]),
+                            min(y1 + max(c[3] for c in crops), self.geometry[1])))
+        elif crops:
+            for x, y, w, h in box_config["rects"]:
+                regions += [(x + c[0], y + c[1], x + c[2], y + c[3]) for c in crops]
+        return regions
+
+    # -> float boxes on the recognition screen
+    def find_floats(self, crop, shape, ref_color=None, threshold=150, canny_args=None, kernel=5, repeat=None):
+        return find_floats(self.get_frame(), self.scale_crop(crop), self.scale_box(shape),
+            ref_color, threshold, canny_args, max(round(kernel * self.scale), 1),
+            repeat and self.scale_box(repeat))
+
     def query_set(self, name):
         if name in self.query_set_cache:
             return self.query_set_cache[name]
@@ -227,75 +650,110 @@ class ArkDriver(object):
             return None
         config = self.config["query_sets"][name]
 
-        for dep in config["deps"]:
-            if not self.validate_component(dep):
-                return None
+        if not self.deps_valid(config["deps"]):
+            return None
 
         if config["type"] == "fixed":
-            result = [self.query(q) for q in config["queries"]]
+            if self.batch_ocr:
+                self.prefetch_ocr([(q, None) for q in config["queries"]])
+            result = self.map_parallel(self.query, config["queries"])
 
             self.last_log = {
                 "name": name,
                 "result": result,
-                "screen_img": self._dev.get_screen()
+                "screen_img": self.frame
             }
 
-            self.query_set_cache[name] = result
-            return result
+            return self.query_set_cache.store(name, result, self.query_set_regions(name))
         if config["type"] == "float":
             boxes = self.find_box(config["box"])
-            result = [[self.query(q, (b[0], b[1])) for q in config["queries"]] for b in boxes]
+            if self.batch_ocr:
+                self.prefetch_ocr([(q, (b[0], b[1])) for b in boxes for q in config["queries"]])
+            result = self.query_boxes(config["queries"], boxes)
 
             self.last_log = {
                 "name": name,
                 "result": result,
-                "screen_img": self._dev.get_screen()
+                "screen_img": self.frame
             }
 
-            self.query_set_cache[name] = result
-            return result
+            return self.query_set_cache.store(name, result, self.query_set_regions(name))
         
+    # -> [[query results] of each box]
+    def query_boxes(self, queries, boxes):
+        results = self.map_parallel(lambda qo: self.query(*qo), [(q, (b[0], b[1])) for b in boxes for q in queries])
+        return [results[i:i + len(queries)] for i in range(0, len(results), len(queries))]
+
+    # -> crop moved by offset, None if that leaves the screen
+    def offset_crop(self, crop, offset=None):
+        if not offset:
+            return crop
+        if crop[2] + offset[0] > self.geometry[0] or crop[3] + offset[1] > self.geometry[1]:
+            return None
+        return (crop[0] + offset[0], crop[1] + offset[1], crop[2] + offset[0], crop[3] + offset[1])
+
+    # Reads the batchable OCR queries among [(query config, offset)] not read on this frame yet, in one
+    # batch per lang and config, leaving the texts in the plan steps query reads them from
+    def prefetch_ocr(self, queries):
+        batches = {}
+        for query_config, offset in queries:
+            if query_config["type"] != "ocr" or not ocr_batchable(query_config.get("config", None)):
+                continue
+            crop = self.offset_crop(query_config["crop"], offset)
+            if crop is None:
+                continue
+            key = ocr_key(query_config, crop)
+            batch = batches.setdefault((query_config.get("lang", "chi_sim"), query_config.get("config", None)), {})
+            if key in self.step_cache or key in batch:
+                continue
+            batch[key] = (crop, self.run_step(binary_key(query_config, crop),
+                lambda: ocr_binary(self.crop_screen_cv(crop, "luma"), query_config.get("threshold", 200))))
+        batches = [(lang, config, batch) for (lang, config), batch in batches.items() if len(batch) > 1]
+        read = lambda b: ocr_binary_texts([binary for _, binary in b[2].values()], b[0], b[1])
+        for (_, _, batch), texts in zip(batches, self.map_parallel(read, batches)):
+            for (key, (crop, _)), text in zip(batch.items(), texts):
+                self.step_cache.store(key, text, [crop])
+
     def query(self, query_config, offset=None):
         if query_config["type"] == "ocr":
-            crop = query_config["crop"]
-            if offset:
-                if crop[2] + offset[0] > self.geometry[0] or crop[3] + offset[1] > self.geometry[1]:
-                    return None
-                crop = (crop[0] + offset[0], crop[1] + offset[1], crop[2] + offset[0], crop[3] + offset[1])
-            cropped = self._dev.get_screen().crop(crop)
-            text = ocr_text(cropped,
-                query_config.get("threshold", 200),
+            crop = self.offset_crop(query_config["crop"], offset)
+            if crop is None:
+                return None
+            binary = self.run_step(binary_key(query_config, crop),
+                lambda: ocr_binary(self.crop_screen_cv(crop, "luma"), query_config.get("threshold", 200)))
+            return self.run_step(ocr_key(query_config, crop), lambda: ocr_binary_text(binary,
                 query_config.get("lang", "chi_sim"),
-                query_config.get("config", None))
-            return text
+                query_config.get("config", None)))
         if query_config["type"] == "ssim":
-            crop = query_config["crop"]
-            if offset:
-                if crop[2] + offset[0] > self.geometry[0] or crop[3] + offset[1] > self.geometry[1]:
-                    return None
-                crop = (crop[0] + offset[0], crop[1] + offset[1], crop[2] + offset[0], crop[3] + offset[1])
-            cropped = self._dev.get_screen().crop(crop)
-            query_dict = self.ref_data["queries"][query_config["query_dict"]]
+            crop = self.offset_crop(query_config["crop"], offset)
+            if crop is None:
+                return None
             results = []
-            for name in query_dict:
-                ref = bytes_to_pil(query_dict[name])
-                ref, mask = extract_alpha(ref)
-                preprocessed, _ = extract_alpha(ref)
-
-                if mask:
-                    preprocessed = Image.composite(preprocessed, Image.new(preprocessed.mode, preprocessed.size), mask)
-                    ref = Image.composite(ref, Image.new(ref.mode, ref.size), mask)
-                if config.get("threshold", None):
-                    preprocessed =  binarize(preprocessed, config["threshold"])
-                if query_config.get("canny_args", None):
-                    preprocessed = canny(preprocessed, *query_config["canny_args"])
-
-                results.append((ssim(ref, preprocessed), name))
-
-            results = [r for r in results if r >= query_config.get("min_conf", 0.8)]
+            for name, (ref, mask, ref_stats) in self.refs.query_dict(query_config["query_dict"]).items():
+                masked = (query_config["query_dict"], name) if mask is not None else None
+                preprocessed = self.run_step(prep_key(query_config, crop, masked), lambda: self.preprocess_crop(crop, mask,
+                    query_config.get("threshold", None),
+                    query_config.get("canny_args", None)))
+                results.append((ssim_stats_cv(preprocessed, ref_stats), name))
+
+            results = [r for r in results if r[0] >= query_config.get("min_conf", 0.8)]
             results.sort(key=lambda x: x[0])
             results.reverse()
             return results
+        if query_config["type"] == "glyph":
+            crop = self.offset_crop(query_config["crop"], offset)
+            if crop is None:
+                return None
+            text = None
+            if query_config["glyph_set"] in self.ref_data["glyphs"]:
+                text = self.refs.glyph_set(query_config["glyph_set"]).read(self.crop_screen_cv(crop, "luma"),
+                    query_config.get("threshold", 200),
+                    query_config.get("max_dist", 0.1))
+            # Read as an ocr query with the same settings until the glyph set is recorded, or when it
+            # does not know a character
+            if text is None or "?" in text:
+                text = self.query(dict(query_config, type="ocr"), offset)
+            return text
         if query_config["type"] == "tap":
             tap_offset = query_config["tap_offset"]
             if offset:
@@ -304,37 +762,72 @@ class ArkDriver(object):
                 tap_offset = (tap_offset[0] + offset[0], tap_offset[1] + offset[1])
             return tap_offset
 
+    # Float query sets are read incrementally: the list displacement between frames is estimated
+    # on the box crop, and only boxes not stitched into the search's index before are queried.
+    # Swipes that do not move the list end the search. last_log["found_at"] is the position of
+    # the center of the first match on the list from its start, None if not known.
     def search(self, name, callback):
         if not name in self.config["searches"]:
             return None
         config = self.config["searches"][name]
 
-        for dep in config["deps"]:
-            if not self.validate_component(dep):
-                return None
-
+        if not self.deps_valid(config["deps"]):
+            return None
 
+        query_set_config = self.config["query_sets"][config["query_set"]]
+        strip = None
+        if query_set_config["type"] == "float":
+            strip = self.config["boxes"][query_set_config["box"]].get("crop", (0, 0) + tuple(self.geometry))
+        index = ScrollIndex(config.get("tolerance", 10), config.get("max_pixel_diff", 12.0))
         count = -1
         last_query_result = None
+        last_frame = None
+        expected = (0, 0)
+        # The index origin is the list start from the init swipe on, until the displacement is lost
+        anchored = False
+        found_at = None
         search_log = []
         while True:
-            query_result = self.query_set(config["query_set"])
+            if strip is None:
+                query_result = self.query_set(config["query_set"])
+            else:
+                shift = None
+                if last_frame is not None:
+                    shift = self.estimate_shift(last_frame, strip, expected)
+                    if shift == (0, 0):
+                        # The init swipe leaves a list already at its start in place
+                        if count > 0:
+                            result = []
+                            status = "Repeated result"
+                            break
+                    elif shift is None or count == 0:
+                        index.reset()
+                    else:
+                        index.move(shift)
+                    anchored = count == 0 or (anchored and shift is not None)
+                new_boxes = self.query_set_new_boxes(config["query_set"], index, shift if count > 0 else None)
+                query_result = new_boxes and [r for _, r in new_boxes]
             search_log.append(query_result)
-            result = [r for r in query_result if callback(r)]
+            result = [r for r in query_result or [] if callback(r)]
             if result:
+                if strip is not None and anchored:
+                    found_at = next(index.position((b[0] + b[2] / 2, b[1] + b[3] / 2)) for b, r in new_boxes if callback(r))
                 status = "Found"
                 break
-            
-            if last_query_result == query_result:
-                result = []
-                status = "Repeated result"
-                break
-            last_query_result = query_result
+
+            if strip is None:
+                if last_query_result == query_result:
+                    result = []
+                    status = "Repeated result"
+                    break
+                last_query_result = query_result
+            last_frame = self.get_frame()
 
             if count == -1:
                 self.swipe_refresh(*config["init_swipe"])
             else:
                 self.swipe_refresh(*config["next_swipe"])
+                expected = tuple(config["next_swipe"][2:4])
             count += 1
             if count > config["bound"]:
                 result = []
@@ -345,16 +838,109 @@ class ArkDriver(object):
             "name": name,
             "result": result,
             "search_log": search_log,
+            "index": index.stitched(),
+            "found_at": found_at,
             "status": status,
-            "screen_img": self._dev.get_screen()
+            "screen_img": self.frame
         }
         return result
 
+    # Search remembering where on list it found item, in stats["search_locations"][(name, list)][item].
+    # A known item is jumped to with one computed swipe after the init swipe, the whole list
+    # is searched only when it is not there.
+    def search_located(self, name, callback, list_key, item):
+        locations = self.stats.setdefault("search_locations", {}).setdefault((name, list_key), {})
+        if item in locations:
+            result = self.search_jump(name, callback, locations[item])
+            if result:
+                return result
+            print("  {} not at its last location, searching the whole list".format(item))
+        result = self.search(name, callback)
+        if result and self.last_log["found_at"] is not None:
+            locations[item] = self.last_log["found_at"]
+        elif not result:
+            locations.pop(item, None)
+        self.save_stats()
+        return result
+
+    # Swipes the (x, y) position of a box center from the list start to the middle of the box crop
+    # and searches the screen
+    # -> matching query set results, None if the deps do not match
+    def search_jump(self, name, callback, position):
+        config = self.config["searches"][name]
+        if not self.deps_valid(config["deps"]):
+            return None
+        query_set_config = self.config["query_sets"][config["query_set"]]
+        x0, y0, x1, y1 = self.config["boxes"][query_set_config["box"]].get("crop", (0, 0) + tuple(self.geometry))
+        self.swipe_refresh(*config["init_swipe"])
+        swipes = jump_swipes((x0, y0, x1, y1), position, config["next_swipe"])
+        for swipe in swipes:
+            self.swipe_refresh(*swipe)
+        query_result = self.query_set(config["query_set"])
+        result = [r for r in query_result or [] if callback(r)]
+
+        self.last_log = {
+            "name": name,
+            "result": result,
+            "position": position,
+            "swipes": len(swipes),
+            "screen_img": self.frame
+        }
+        return result
+
+    # -> (dx, dy) the content of crop moved by since last_frame in config units, None if unknown
+    def estimate_shift(self, last_frame, crop, expected=(0, 0)):
+        scaled = self.scale_crop(crop)
+        shift, _ = estimate_shift_cv(last_frame.gray(scaled), self.get_frame().gray(scaled),
+            (expected[0] * self.scale, expected[1] * self.scale))
+        if shift is None or shift == (0, 0):
+            return shift
+        return (shift[0] / self.scale, shift[1] / self.scale)
+
+    # -> (x0, y0, x1, y1) around a box of a float query set covering what its queries read, relative to the box
+    def query_box_region(self, config, box):
+        crops = [q["crop"] for q in config["queries"] if "crop" in q]
+        if not crops:
+            return (0, 0, box[2], box[3])
+        return (min(c[0] for c in crops), min(c[1] for c in crops), max(c[2] for c in crops), max(c[3] for c in crops))
+
+    # Float query set results of the boxes not in index, which are added to it
+    # motion: as for find_box
+    # -> [(box, [query results]) of each new box], None if the deps do not match
+    def query_set_new_boxes(self, name, index, motion=None):
+        config = self.config["query_sets"][name]
+        if not self.deps_valid(config["deps"]):
+            return None
+        new_boxes = []
+        for b in self.find_box(config["box"], motion=motion) or []:
+            x0, y0, x1, y1 = self.query_box_region(config, b)
+            crop = (b[0] + x0, b[1] + y0, b[0] + x1, b[1] + y1)
+            pixels = None
+            if crop[0] >= 0 and crop[1] >= 0 and crop[2] <= self.geometry[0] and crop[3] <= self.geometry[1]:
+                pixels = self.crop_screen_cv(crop, "gray")
+                if index.lookup(b, pixels) is not None:
+                    continue
+            new_boxes.append((b, pixels))
+        if self.batch_ocr:
+            self.prefetch_ocr([(q, (b[0], b[1])) for b, _ in new_boxes for q in config["queries"]])
+        results = []
+        for (b, pixels), result in zip(new_boxes, self.query_boxes(config["queries"], [b for b, _ in new_boxes])):
+            # Boxes partly off screen are read again once they are whole
+            if pixels is not None and None not in result:
+                index.add(b, pixels, result)
+            results.append((b, result))
+
+        self.last_log = {
+            "name": name,
+            "result": results,
+            "screen_img": self.frame
+        }
+        return results
 
     def new_ssim_component(self, crop,
         min_conf=0.8, threshold=None, canny_args=None,
         tap_offset=None, show_ref=True):
-        cropped = self._dev.get_screen().crop(crop)
+        cropped = self.reference_screen().crop(crop)
         if threshold:
             cropped = binarize(cropped, threshold)
         if canny_args:
@@ -377,7 +963,7 @@ class ArkDriver(object):
     def new_ocr_component(self, crop,
         threshold=200, lang="chi_sim", config=None,
         tap_offset=None, print_ref=True):
-        cropped = self._dev.get_screen().crop(crop)
+        cropped = self.reference_screen().crop(crop)
         text = ocr_text(cropped, threshold, lang, config)
         if print_ref:
             print(text)
@@ -404,8 +990,7 @@ class ArkDriver(object):
             "repeat": repeat
         }
         if draw:
-            floats = find_floats(self._dev.get_screen(), crop, shape, ref_color, threshold, canny_args, kernel, repeat)
-            draw_shapes(self._dev.get_screen(), floats).show()
+            draw_shapes(self.get_frame(), self.find_floats(crop, shape, ref_color, threshold, canny_args, kernel, repeat)).show()
         return spec
     
     def new_fixed_box(self, deps, rects, draw=True) :
@@ -415,12 +1000,14 @@ class ArkDriver(object):
             "rects": rects
         }
         if draw:
-            draw_shapes(self._dev.get_screen(), rects).show()
+            draw_shapes(self.get_frame(), [self.scale_box(r) for r in rects]).show()
         return spec
 
+    # pyramid: number of halvings for a coarse search refined within refine pixels at full resolution
     def new_subimage_box(self, deps, crop, subimages,
             method=cv2.TM_CCOEFF_NORMED, match_th=0.2,
-            ssim_th=0.6, weights=(1.0, 1.0, 1.0), draw=True):
+            ssim_th=0.6, weights=(1.0, 1.0, 1.0),
+            pyramid=0, refine=4, coarse_th=None, draw=True):
         spec = {
             "type": "subimage",
             "deps":deps,
@@ -429,12 +1016,15 @@ class ArkDriver(object):
             "method": method,
             "match_th": match_th,
             "ssim_th": ssim_th,
-            "weights": weights
+            "weights": weights,
+            "pyramid": pyramid,
+            "refine": refine,
+            "coarse_th": coarse_th
         }
         if draw:
-            subs = [bytes_to_pil(self.ref_data["subimages"][name]) for name in subimages]
-            boxes = match_sub_image(self._dev.get_screen(), subs, crop, method, match_th, ssim_th, weights)
-            draw_shapes(self._dev.get_screen(), boxes).show()
+            subs = [self.refs.subimage(name) for name in subimages]
+            boxes = match_sub_image(self.get_frame(), subs, self.scale_crop(crop), method, match_th, ssim_th, weights, pyramid, refine, coarse_th)
+            draw_shapes(self.get_frame(), boxes).show()
         return spec
 
 
@@ -480,7 +1070,7 @@ class ArkDriver(object):
         if test_offset:
             crop = (crop[0] + test_offset[0], crop[1] + test_offset[1],
                     crop[2] + test_offset[0], crop[3] + test_offset[1])
-        cropped = self._dev.get_screen().crop(crop)
+        cropped = self.reference_screen().crop(crop)
         if threshold:
             cropped = binarize(cropped, threshold)
         if canny_args:
@@ -491,6 +1081,35 @@ class ArkDriver(object):
             print(results)
         return spec
 
+    # lang, config: of the ocr read standing in for the glyph set
+    def new_glyph_query(self, crop, glyph_set, threshold=200, max_dist=0.1, lang="eng", config=None, print_ref=True, test_offset=None):
+        spec = {
+            "type": "glyph",
+            "crop": crop,
+            "glyph_set": glyph_set,
+            "threshold": threshold,
+            "max_dist": max_dist,
+            "lang": lang,
+            "config": config
+        }
+        text = self.query(spec, test_offset)
+        if print_ref:
+            print(text)
+        return spec
+
+    # samples: [(screen image, text)], text None to label the crop with tesseract
+    def new_glyph_set(self, samples, crop, threshold=200, lang="eng", config=None, print_ref=True):
+        cv_samples = []
+        for screen, text in samples:
+            cropped = pil_to_cv(screen.crop(crop))
+            if text is None:
+                text = ocr_text(cropped, threshold, lang, config)
+            cv_samples.append((cropped, text, threshold))
+        data, skipped = build_glyph_data(cv_samples)
+        if print_ref:
+            print("Glyphs:", "".join(sorted(set(label for label, _ in data))), "Skipped samples:", skipped)
+        return data
+
     def new_tap_query(self, tap_offset):
         spec = {
             "type":"tap",
@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+from .cvUtils import pil_to_bytes, bytes_to_pil, pil_to_cv
+
+THUMB_SIZE = (8, 8)
+# Mean absolute difference in 0-255 units between thumbnails, auto derived
+# fingerprints reject only crops far from the reference
+DEFAULT_TOL = 48.0
+CALIBRATION_MARGIN = 8.0
+
+def thumbnail(cv_image):
+    return cv2.resize(cv_image, THUMB_SIZE, interpolation=cv2.INTER_AREA)
+
+def thumb_distance(thumb_a, thumb_b):
+    return float(np.abs(thumb_a.astype(np.int16) - thumb_b.astype(np.int16)).mean())
+
+class Fingerprint(object):
+    def __init__(self, thumb, tol=DEFAULT_TOL):
+        self.thumb = thumb
+        self.tol = tol
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(pil_to_cv(bytes_to_pil(data["thumb"])), data["tol"])
+
+    def to_data(self):
+        return {"thumb": pil_to_bytes(self.thumb), "tol": self.tol}
+
+    def distance(self, cv_image):
+        if len(cv_image.shape) != len(self.thumb.shape):
+            return 0.0
+        return thumb_distance(thumbnail(cv_image), self.thumb)
+
+    def accepts(self, cv_image):
+        return self.distance(cv_image) <= self.tol
+
+# crops: preprocessed crops the full check accepted, -> fingerprint accepting all of them
+def calibrate_fingerprint(crops, fingerprint=None):
+    if fingerprint is None:
+        thumbs = np.stack([thumbnail(c).astype(np.float32) for c in crops])
+        fingerprint = Fingerprint(np.round(thumbs.mean(axis=0)).astype(np.uint8), 0.0)
+    worst = max(fingerprint.distance(c) for c in crops)
+    if worst > fingerprint.tol:
+        fingerprint = Fingerprint(fingerprint.thumb, worst + CALIBRATION_MARGIN)
+    return fingerprint
@@ -0,0 +1,82 @@
+import cv2
+import numpy as np
+from PIL import Image
+from .cvUtils import luma_cv
+
+# One captured screen held as a single RGB(A) buffer. Crops are views into it or into
+# derived planes (bgr, gray, per-channel), each computed at most once per frame.
+# The exact PIL luma costs too much for the whole screen, it is cached per crop instead.
+# Planes are read-only, consumers must copy before writing.
+class Frame(object):
+    def __init__(self, array, ts=0.0):
+        self.array = array
+        self.array.flags.writeable = False
+        self.ts = ts
+        self._planes = {}
+        self._luma_crops = {}
+        self._pil = None
+
+    @property
+    def size(self):
+        return (self.array.shape[1], self.array.shape[0])
+
+    def plane(self, name):
+        if name not in self._planes:
+            if name == "bgr":
+                plane = cv2.cvtColor(self.array, cv2.COLOR_RGBA2BGR if self.array.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+            elif name == "luma":
+                plane = luma_cv(self.plane("bgr"))
+            elif name == "gray":
+                plane = cv2.cvtColor(self.plane("bgr"), cv2.COLOR_BGR2GRAY)
+            elif name == "thumb":
+                # Gray downsampled 8x, for cheap frame to frame comparisons
+                w, h = self.size
+                plane = cv2.resize(self.plane("gray"), (max(w // 8, 1), max(h // 8, 1)), interpolation=cv2.INTER_AREA)
+            else:
+                # "b", "g" or "r"
+                plane = np.ascontiguousarray(self.array[:, :, "rgb".index(name)])
+            plane.flags.writeable = False
+            self._planes[name] = plane
+        return self._planes[name]
+
+    # (x0, y0, x1, y1) crop -> view into the plane
+    def crop(self, crop, name="bgr"):
+        if name == "luma":
+            return self.luma(crop)
+        plane = self.array if name == "rgb" else self.plane(name)
+        if crop is None:
+            return plane
+        x0, y0, x1, y1 = crop
+        return plane[y0:y1, x0:x1]
+
+    def bgr(self, crop=None):
+        return self.crop(crop, "bgr")
+
+    def luma(self, crop=None):
+        if crop is None:
+            return self.plane("luma")
+        crop = tuple(crop)
+        if crop not in self._luma_crops:
+            luma = luma_cv(self.bgr(crop))
+            luma.flags.writeable = False
+            self._luma_crops[crop] = luma
+        return self._luma_crops[crop]
+
+    def gray(self, crop=None):
+        return self.crop(crop, "gray")
+
+    # -> mean absolute difference of the two frames' thumbnails, in 0-255 gray levels
+    def difference(self, other):
+        return float(cv2.absdiff(self.plane("thumb"), other.plane("thumb")).mean())
+
+    def resize(self, size):
+        return Frame(cv2.resize(self.array, size, interpolation=cv2.INTER_AREA), self.ts)
+
+    def to_pil(self):
+        if self._pil is None:
+            mode = "RGBA" if self.array.shape[2] == 4 else "RGB"
+            self._pil = Image.frombuffer(mode, self.size, self.array, "raw", mode, 0, 1)
+        return self._pil
+
+    def show(self, title=None):
+        self.to_pil().show(title=title)
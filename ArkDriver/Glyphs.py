@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+from .cvUtils import binarize_cv, luma_cv, pil_to_bytes, bytes_to_pil
+
+GLYPH_SIZE = (12, 16)
+
+# Binarized crop with the text as white foreground, whichever polarity the screen uses
+def glyph_binary(cv_image, threshold):
+    binary = binarize_cv(luma_cv(cv_image), threshold)
+    if np.count_nonzero(binary) * 2 > binary.size:
+        binary = 255 - binary
+    return binary
+
+# -> [(x, y, w, h)] of each character from left to right,
+# connected components overlapping mostly in x are taken as one character
+def segment_glyphs(binary, min_area=4):
+    n, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    rects = sorted(tuple(int(v) for v in stats[i][:4]) for i in range(1, n) if stats[i][4] >= min_area)
+    merged = []
+    for x, y, w, h in rects:
+        if merged:
+            mx, my, mw, mh = merged[-1]
+            if min(mx + mw, x + w) - max(mx, x) > min(mw, w) / 2:
+                nx, ny = min(mx, x), min(my, y)
+                merged[-1] = (nx, ny, max(mx + mw, x + w) - nx, max(my + mh, y + h) - ny)
+                continue
+        merged.append((x, y, w, h))
+    return merged
+
+# Scales a glyph into the GLYPH_SIZE box keeping its aspect ratio
+def normalize_glyph(glyph):
+    gw, gh = GLYPH_SIZE
+    h, w = glyph.shape
+    scale = min(gw / w, gh / h)
+    nw, nh = max(1, round(w * scale)), max(1, round(h * scale))
+    canvas = np.zeros((gh, gw), np.uint8)
+    x, y = (gw - nw) // 2, (gh - nh) // 2
+    canvas[y:y+nh, x:x+nw] = cv2.resize(glyph, (nw, nh), interpolation=cv2.INTER_AREA)
+    return canvas
+
+def extract_glyphs(cv_image, threshold):
+    binary = glyph_binary(cv_image, threshold)
+    return [normalize_glyph(binary[y:y+h, x:x+w]) for x, y, w, h in segment_glyphs(binary)]
+
+class GlyphSet(object):
+    def __init__(self, labels, glyphs):
+        self.labels = list(labels)
+        self.vectors = np.stack([g.reshape(-1) for g in glyphs]).astype(np.float32) / 255
+        self.sq_norms = (self.vectors ** 2).sum(axis=1)
+
+    # Nearest neighbour over all glyphs at once -> (labels, mean squared pixel distances)
+    def classify(self, glyphs):
+        if not glyphs:
+            return ([], np.zeros(0, np.float32))
+        queries = np.stack([g.reshape(-1) for g in glyphs]).astype(np.float32) / 255
+        dists = (queries ** 2).sum(axis=1)[:, None] + self.sq_norms[None, :] - 2 * queries @ self.vectors.T
+        nearest = dists.argmin(axis=1)
+        return ([self.labels[i] for i in nearest],
+            np.maximum(dists[np.arange(len(glyphs)), nearest], 0) / self.vectors.shape[1])
+
+    # Unrecognized characters come out as "?"
+    def read(self, cv_image, threshold=200, max_dist=0.1):
+        labels, dists = self.classify(extract_glyphs(cv_image, threshold))
+        return "".join(l if d <= max_dist else "?" for l, d in zip(labels, dists))
+
+# samples: [(cv crop, text, threshold)], samples whose segmentation does not match the text are skipped
+# -> ([(label, glyph png bytes)], skipped sample indices)
+def build_glyph_data(samples):
+    data = []
+    seen = set()
+    skipped = []
+    for n, (cv_image, text, threshold) in enumerate(samples):
+        chars = [c for c in text if not c.isspace()]
+        glyphs = extract_glyphs(cv_image, threshold)
+        if len(glyphs) != len(chars):
+            skipped.append(n)
+            continue
+        for char, glyph in zip(chars, glyphs):
+            key = (char, glyph.tobytes())
+            if key in seen:
+                continue
+            seen.add(key)
+            data.append((char, pil_to_bytes(glyph)))
+    return (data, skipped)
+
+def load_glyph_set(data):
+    return GlyphSet([label for label, _ in data], [np.array(bytes_to_pil(png)) for _, png in data])
@@ -0,0 +1,75 @@
+import heapq
+
+# Latency in seconds assumed for a transition until it has been timed
+DEFAULT_EDGE_COST = 5.0
+EDGE_COST_EMA = 0.3
+
+# Pages of the UI and the taps leading between them, from config["navigation"]:
+#   pages:
+#     <page>:
+#       component: <component recognizing the page>
+#       priority: <preferred when several pages match, default 0>
+#       chain: <opens without loading, the taps into and out of it are sent in one batch, default false>
+#       edges: {<next page>: <component to tap>}
+# Transition latencies are learned into stats["edge_costs"] and routes minimize their sum.
+class Navigator(object):
+    def __init__(self, graph, stats):
+        self.pages = graph.get("pages", {}) if graph else {}
+        self.costs = stats.setdefault("edge_costs", {})
+
+    def components(self):
+        return [page["component"] for page in self.pages.values()]
+
+    # -> page recognized by the matched components, None if there is none
+    def page_of(self, matched):
+        candidates = [name for name, page in self.pages.items() if page["component"] in matched]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda name: self.pages[name].get("priority", 0))
+
+    def cost(self, src, dst):
+        return self.costs.get((src, dst), DEFAULT_EDGE_COST)
+
+    def record(self, src, dst, elapsed):
+        cost = self.costs.get((src, dst), None)
+        self.costs[(src, dst)] = elapsed if cost is None else cost + EDGE_COST_EMA * (elapsed - cost)
+
+    # -> route split into runs of hops whose taps are sent together, each run ends at a page without chain
+    def chains(self, route):
+        runs = [[]]
+        for hop in route:
+            runs[-1].append(hop)
+            if not self.pages[hop[1]].get("chain", False):
+                runs.append([])
+        return [run for run in runs if run]
+
+    # Dijkstra over the learned costs
+    # -> [(page, next page, component to tap)] of the cheapest route, None if dst is unreachable
+    def route(self, src, dst):
+        if src not in self.pages or dst not in self.pages:
+            return None
+        best = {src: 0.0}
+        prev = {}
+        queue = [(0.0, src)]
+        while queue:
+            cost, page = heapq.heappop(queue)
+            if page == dst:
+                break
+            if cost > best[page]:
+                continue
+            for next_page, tap in self.pages[page].get("edges", {}).items():
+                next_cost = cost + self.cost(page, next_page)
+                if next_cost < best.get(next_page, float("inf")):
+                    best[next_page] = next_cost
+                    prev[next_page] = (page, tap)
+                    heapq.heappush(queue, (next_cost, next_page))
+        if dst not in best:
+            return None
+        route = []
+        page = dst
+        while page != src:
+            prev_page, tap = prev[page]
+            route.append((prev_page, page, tap))
+            page = prev_page
+        route.reverse()
+        return route
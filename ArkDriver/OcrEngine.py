@@ -0,0 +1,86 @@
+from threading import Lock, local
+from tempfile import TemporaryDirectory
+from PIL import Image
+from pytesseract import image_to_string
+import os
+import re
+try:
+    from tesserocr import PyTessBaseAPI
+except ImportError:
+    PyTessBaseAPI = None
+
+DEFAULT_PSM = 3
+# Separates the texts of the pages of a multi page tesseract run
+PAGE_SEPARATOR = "\f"
+
+def parse_config(config):
+    config = config or ""
+    match = re.search(r"--psm\s+(\d+)", config)
+    psm = int(match.group(1)) if match else DEFAULT_PSM
+    rest = re.sub(r"--psm\s+\d+", "", config).strip()
+    return (psm, rest)
+
+# Keeps one loaded tesseract instance per (lang, psm) and thread alive across calls, so threads
+# recognize in parallel, falls back to pytesseract when tesserocr is unavailable or extra options are given
+class OcrEngine(object):
+    def __init__(self):
+        self._apis = []
+        self._lock = Lock()
+        self._local = local()
+        self._generation = 0
+
+    def in_process(self, config):
+        return PyTessBaseAPI is not None and not parse_config(config)[1]
+
+    def api(self, lang, psm):
+        if getattr(self._local, "generation", None) != self._generation:
+            self._local.apis = {}
+            self._local.generation = self._generation
+        key = (lang, psm)
+        if key not in self._local.apis:
+            api = PyTessBaseAPI(lang=lang, psm=psm)
+            with self._lock:
+                self._apis.append(api)
+            self._local.apis[key] = api
+        return self._local.apis[key]
+
+    # Takes an 8 bit single channel numpy image
+    def recognize(self, image, lang="chi_sim", config=None):
+        if not self.in_process(config):
+            return image_to_string(Image.fromarray(image), lang=lang, config=config).strip()
+        psm, _ = parse_config(config)
+        api = self.api(lang, psm)
+        api.SetImageBytes(image.tobytes(), image.shape[1], image.shape[0], 1, image.shape[1])
+        return api.GetUTF8Text().strip()
+
+    # -> texts of several images with the same lang and config. Through pytesseract they are read
+    # in a single tesseract run over a list file, each image a page read with the config, so the
+    # process is started once. In process there is no such cost and each image is read on its own.
+    def recognize_batch(self, images, lang="chi_sim", config=None):
+        if len(images) == 1 or self.in_process(config):
+            return [self.recognize(image, lang, config) for image in images]
+        with TemporaryDirectory(prefix="tess_batch_") as tmp:
+            paths = []
+            for n, image in enumerate(images):
+                paths.append(os.path.join(tmp, "{}.png".format(n)))
+                Image.fromarray(image).save(paths[-1])
+            list_fn = os.path.join(tmp, "pages.txt")
+            with open(list_fn, "w") as f:
+                f.write("\n".join(paths) + "\n")
+            pages = image_to_string(list_fn, lang=lang, config=config).split(PAGE_SEPARATOR)
+        # Depending on the tesseract version the separator also follows the last page
+        if len(pages) == len(images) + 1 and not pages[-1].strip():
+            pages.pop()
+        if len(pages) != len(images):
+            return [self.recognize(image, lang, config) for image in images]
+        return [page.strip() for page in pages]
+
+    # Not to be called while other threads recognize
+    def close(self):
+        with self._lock:
+            for api in self._apis:
+                api.End()
+            self._apis.clear()
+            self._generation += 1
+
+ocr_engine = OcrEngine()
@@ -0,0 +1,43 @@
+# Keys identifying the work a check does on a frame. Checks with equal keys
+# share one result per frame, e.g. two popups read from the same crop cost one OCR call.
+
+def freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+def ocr_key(config, crop=None):
+    return ("ocr", tuple(crop or config["crop"]), config.get("threshold", 200), config.get("lang", "chi_sim"), config.get("config", None))
+
+def binary_key(config, crop=None):
+    return ("binary", tuple(crop or config["crop"]), config.get("threshold", 200))
+
+# masked: key of the reference whose mask is applied, masks are not shared
+def prep_key(config, crop=None, masked=None):
+    return ("prep", tuple(crop or config["crop"]), config.get("threshold", None), freeze(config.get("canny_args", None)), masked)
+
+def box_key(config):
+    return ("box", freeze(dict((k, v) for k, v in config.items() if k != "deps")))
+
+class RecognitionPlan(object):
+    def __init__(self, config, refs):
+        self.config = config
+        self.refs = refs
+        self.components = {}
+
+    def invalidate(self, name):
+        self.components.pop(name, None)
+
+    # -> [step keys] the component check runs, in order
+    def component_steps(self, name):
+        if name not in self.components:
+            config = self.config["components"][name]
+            if config["type"] == "ssim":
+                masked = name if self.refs.component(name)[1] is not None else None
+                self.components[name] = [prep_key(config, masked=masked)]
+            else:
+                self.components[name] = [binary_key(config), ocr_key(config)]
+        return self.components[name]
+
@@ -0,0 +1,102 @@
+import numpy as np
+import cv2
+from .cvUtils import bytes_to_pil, pil_to_cv, apply_mask_cv, ssim_stats
+from .Glyphs import load_glyph_set
+from .Fingerprint import Fingerprint, thumbnail
+
+# -> (cv array, alpha array or None)
+def split_alpha_cv(pil_img):
+    if pil_img.mode not in ("LA", "RGBA"):
+        return (pil_to_cv(pil_img), None)
+    array = np.array(pil_img)
+    if pil_img.mode == "LA":
+        return (np.ascontiguousarray(array[:, :, 0]), array[:, :, 1])
+    return (cv2.cvtColor(array[:, :, :3], cv2.COLOR_RGB2BGR), array[:, :, 3])
+
+# Resizes an array captured at config geometry to the recognition scale,
+# binarized references stay binary
+def scale_ref(cv_image, scale, interpolation=cv2.INTER_AREA):
+    if scale == 1.0:
+        return cv_image
+    h, w = cv_image.shape[:2]
+    binary = len(cv_image.shape) == 2 and not np.any((cv_image != 0) & (cv_image != 255))
+    scaled = cv2.resize(cv_image, (round(w * scale), round(h * scale)), interpolation=interpolation)
+    if binary:
+        scaled = cv2.threshold(scaled, 127, 255, cv2.THRESH_BINARY)[1]
+    return scaled
+
+# Decodes PNG reference data once, with the mask already applied to the reference
+# -> (ref cv array, mask array or None, ssim statistics of ref)
+def compile_ref(data, scale=1.0):
+    ref, mask = split_alpha_cv(bytes_to_pil(data))
+    ref = scale_ref(ref, scale)
+    if mask is None or mask.min() == 255:
+        mask = None
+    else:
+        mask = scale_ref(mask, scale, cv2.INTER_NEAREST)
+        ref = apply_mask_cv(ref, mask)
+    return (ref, mask, ssim_stats(ref))
+
+class RefStore(object):
+    def __init__(self, ref_data, scale=1.0):
+        self.ref_data = ref_data
+        self.scale = scale
+        self.components = {}
+        self.queries = {}
+        self.subimages = {}
+        self.glyphs = {}
+        self.fingerprints = {}
+
+    def compile_all(self):
+        for name in self.ref_data["components"]:
+            self.component(name)
+        for name in self.ref_data["queries"]:
+            self.query_dict(name)
+        for name in self.ref_data["subimages"]:
+            self.subimage(name)
+        for name in self.ref_data.get("glyphs", {}):
+            self.glyph_set(name)
+
+    def set_scale(self, scale):
+        if scale == self.scale:
+            return
+        self.scale = scale
+        for kind in ("components", "queries", "subimages", "fingerprints"):
+            getattr(self, kind).clear()
+
+    def invalidate(self, kind, name):
+        getattr(self, kind).pop(name, None)
+
+    def component(self, name):
+        if name not in self.components:
+            self.components[name] = compile_ref(self.ref_data["components"][name], self.scale)
+        return self.components[name]
+
+    # -> {entry name: compiled ref}
+    def query_dict(self, name):
+        if name not in self.queries:
+            self.queries[name] = dict((k, compile_ref(v, self.scale)) for k, v in self.ref_data["queries"][name].items())
+        return self.queries[name]
+
+    # Templates are matched unmasked, alpha is dropped
+    def subimage(self, name):
+        if name not in self.subimages:
+            self.subimages[name] = scale_ref(pil_to_cv(bytes_to_pil(self.ref_data["subimages"][name])), self.scale)
+        return self.subimages[name]
+
+    def glyph_set(self, name):
+        if name not in self.glyphs:
+            self.glyphs[name] = load_glyph_set(self.ref_data["glyphs"][name])
+        return self.glyphs[name]
+
+    # Calibrated fingerprints from ref_data take precedence over ones derived from the reference image,
+    # OCR components only have calibrated ones
+    def fingerprint(self, name, config):
+        if name not in self.fingerprints:
+            if name in self.ref_data.get("fingerprints", {}):
+                self.fingerprints[name] = Fingerprint.from_data(self.ref_data["fingerprints"][name])
+            elif config["type"] == "ssim" and name in self.ref_data["components"]:
+                self.fingerprints[name] = Fingerprint(thumbnail(self.component(name)[0]))
+            else:
+                self.fingerprints[name] = None
+        return self.fingerprints[name]
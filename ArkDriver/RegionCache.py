@@ -0,0 +1,51 @@
+import zlib
+import numpy as np
+
+# crc32 of the pixels of (x0, y0, x1, y1) config regions on the current frame, each computed once per frame
+class RegionHasher(object):
+    def __init__(self, to_frame_crop):
+        self.to_frame_crop = to_frame_crop
+        self.frame = None
+        self.hashes = {}
+
+    def set_frame(self, frame):
+        self.frame = frame
+        self.hashes = {}
+
+    def __call__(self, region):
+        region = tuple(region)
+        if region not in self.hashes:
+            pixels = self.frame.crop(self.to_frame_crop(region), "rgb")
+            self.hashes[region] = zlib.crc32(np.ascontiguousarray(pixels))
+        return self.hashes[region]
+
+# Results kept across frames for as long as the pixels of the regions they were computed from do not change
+class RegionCache(object):
+    def __init__(self, hasher):
+        self.hasher = hasher
+        self.entries = {}
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key][0]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def store(self, key, value, regions):
+        self.entries[key] = (value, [(tuple(r), self.hasher(r)) for r in regions])
+        return value
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self.entries.clear()
+
+    # Drops the entries with a region changed on the hasher's new frame
+    def refresh(self):
+        self.entries = dict((k, v) for k, v in self.entries.items()
+            if all(self.hasher(r) == h for r, h in v[1]))
@@ -0,0 +1,48 @@
+from time import time
+
+# Sanity regenerates one point every 6 minutes up to its maximum
+SANITY_REGEN_SECS = 360
+
+# Sanity estimated from the last reading, without reading the screen again.
+# The regeneration phase at a reading is unknown, estimates assume a full period to each point.
+class SanityClock(object):
+    def __init__(self):
+        self.reading = None
+        self.max_value = None
+        self.ts = None
+
+    def read(self, value, max_value=None, ts=None):
+        self.reading = value
+        self.max_value = max_value
+        self.ts = time() if ts is None else ts
+
+    def spend(self, amount, ts=None):
+        ts = time() if ts is None else ts
+        value = self.value(ts)
+        if value is None:
+            return
+        # Regeneration restarts when spending from the maximum, otherwise the new reading
+        # keeps the phase, stamped at the last point regenerated by ts
+        if self.max_value is None or value < self.max_value:
+            ts = self.ts + ((ts - self.ts) // SANITY_REGEN_SECS) * SANITY_REGEN_SECS
+        self.read(value - amount, self.max_value, ts)
+
+    # -> estimated sanity at ts, None before the first reading
+    def value(self, ts=None):
+        if self.reading is None:
+            return None
+        if self.max_value is not None and self.reading >= self.max_value:
+            return self.reading
+        ts = time() if ts is None else ts
+        value = self.reading + int((ts - self.ts) // SANITY_REGEN_SECS)
+        return value if self.max_value is None else min(value, self.max_value)
+
+    # -> timestamp sanity reaches amount, None before the first reading or if it never will
+    def ready_at(self, amount):
+        if self.reading is None:
+            return None
+        if self.reading >= amount:
+            return self.ts
+        if self.max_value is not None and amount > self.max_value:
+            return None
+        return self.ts + (amount - self.reading) * SANITY_REGEN_SECS
@@ -0,0 +1,65 @@
+import cv2
+import math
+
+# Entries of a scrolling list by position on the virtual list, stitched from frames taken
+# between swipes. Each entry keeps the gray pixels its results were read from, a box at the
+# position of an entry reuses the entry's results only if its pixels still match.
+class ScrollIndex(object):
+    # tolerance: distance in config units within which a box is at an entry's position
+    # max_diff: mean gray difference up to which pixels match
+    def __init__(self, tolerance=10, max_diff=12.0):
+        self.tolerance = tolerance
+        self.max_diff = max_diff
+        self.entries = []
+        self.origin = (0, 0)
+        self.segment = 0
+
+    # Content moved by shift on screen, the screen's origin moved the other way on the list
+    def move(self, shift):
+        self.origin = (self.origin[0] - shift[0], self.origin[1] - shift[1])
+
+    # Displacement unknown, later frames are not stitched to the earlier entries
+    def reset(self):
+        self.origin = (0, 0)
+        self.segment += 1
+
+    def position(self, box):
+        return (box[0] + self.origin[0], box[1] + self.origin[1])
+
+    # -> results of the entry at box matching pixels, None if there is none
+    def lookup(self, box, pixels):
+        x, y = self.position(box)
+        for segment, ex, ey, entry_pixels, result in self.entries:
+            if segment == self.segment and abs(ex - x) <= self.tolerance and abs(ey - y) <= self.tolerance \
+                and entry_pixels.shape == pixels.shape and cv2.absdiff(entry_pixels, pixels).mean() <= self.max_diff:
+                return result
+        return None
+
+    def add(self, box, pixels, result):
+        self.entries.append((self.segment,) + self.position(box) + (pixels.copy(), result))
+
+    # -> [((x, y) on the list, results)] of the entries stitched since the last reset
+    def stitched(self):
+        return sorted((((ex, ey), result) for segment, ex, ey, _, result in self.entries if segment == self.segment),
+            key=lambda e: e[0])
+
+# Swipes bringing the (x, y) position on a list at its start to the middle of crop. Content moves
+# with the finger, only the way swipe (x, y, dx, dy, t) scrolls. The finger crosses crop at the speed
+# of swipe, as few times as it takes.
+# -> [(x, y, dx, dy, t)]
+def jump_swipes(crop, position, swipe):
+    x0, y0, x1, y1 = crop
+    x, y, dx, dy, t = swipe
+    sx = (x0 + x1) / 2 - position[0] if dx else 0
+    sy = (y0 + y1) / 2 - position[1] if dy else 0
+    sx, sy = (sx if sx * dx > 0 else 0), (sy if sy * dy > 0 else 0)
+    mx, my = (x1 - x0) // 20, (y1 - y0) // 20
+    steps = math.ceil(max(abs(sx) / (x1 - x0 - 2 * mx), abs(sy) / (y1 - y0 - 2 * my)))
+    swipes = []
+    for _ in range(steps):
+        step_x, step_y = round(sx / steps), round(sy / steps)
+        start_x = (x1 - mx if step_x < 0 else x0 + mx) if step_x else x
+        start_y = (y1 - my if step_y < 0 else y0 + my) if step_y else y
+        duration = round(t * max(abs(step_x / dx) if dx else 0, abs(step_y / dy) if dy else 0))
+        swipes.append((start_x, start_y, step_x, step_y, duration))
+    return swipes
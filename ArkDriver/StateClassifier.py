@@ -0,0 +1,67 @@
+from .RecognitionPlan import ocr_key
+
+# Rough costs in seconds used until a component has been timed
+SSIM_COST_PER_PIXEL = 1e-7
+OCR_COST_PER_PIXEL = 1e-6
+OCR_CALL_COST = 0.02
+COST_EMA = 0.2
+
+def crop_area(crop):
+    return (crop[2] - crop[0]) * (crop[3] - crop[1])
+
+# Orders component checks into a cascade, cheapest expected cost first.
+# OCR components reading the same crop with the same settings form one group decided by a single call.
+class StateClassifier(object):
+    def __init__(self, components):
+        self.components = components
+        self.costs = {}
+        self.hits = {}
+
+    def prior_cost(self, name):
+        config = self.components[name]
+        area = crop_area(config["crop"])
+        if config["type"] == "ocr":
+            return OCR_CALL_COST + OCR_COST_PER_PIXEL * area
+        return SSIM_COST_PER_PIXEL * area
+
+    def cost(self, name):
+        return self.costs.get(name, self.prior_cost(name))
+
+    def hit_rate(self, name):
+        hits, total = self.hits.get(name, (0, 0))
+        return (hits + 1) / (total + 2)
+
+    def groups(self, names):
+        groups = []
+        ocr_groups = {}
+        for name in names:
+            if name not in self.components:
+                continue
+            config = self.components[name]
+            if config["type"] == "ocr":
+                key = ocr_key(config)
+                if key in ocr_groups:
+                    ocr_groups[key].append(name)
+                    continue
+                ocr_groups[key] = [name]
+                groups.append(ocr_groups[key])
+            else:
+                groups.append([name])
+        return groups
+
+    # first: order by cost over chance of matching, to find any match cheaply
+    # otherwise: order by cost alone
+    def cascade(self, names, first=False):
+        def group_key(group):
+            cost = self.cost(group[0])
+            if first:
+                return cost / sum(self.hit_rate(name) for name in group)
+            return cost
+        return sorted(self.groups(names), key=group_key)
+
+    def record(self, group, elapsed, matched):
+        for name in group:
+            cost = self.costs.get(name, None)
+            self.costs[name] = elapsed if cost is None else cost + COST_EMA * (elapsed - cost)
+            hits, total = self.hits.get(name, (0, 0))
+            self.hits[name] = (hits + (name in matched), total + 1)
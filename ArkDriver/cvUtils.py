@@ -1,48 +1,13 @@
 import cv2
-from PIL import Image, ImageDraw, ImageOps
+from PIL import Image, ImageDraw
 import numpy as np
-from skimage.metrics import structural_similarity
-from scipy.ndimage.filters import maximum_filter
-from scipy.ndimage.morphology import generate_binary_structure, binary_erosion
 from io import BytesIO
-from pytesseract import image_to_string
+from .OcrEngine import ocr_engine
 import random
 
-def detect_peaks(image):
-    """
-    Takes an image and detect the peaks usingthe local maximum filter.
-    Returns a boolean mask of the peaks (i.e. 1 when
-    the pixel's value is the neighborhood maximum, 0 otherwise)
-    """
-
-    # define an 8-connected neighborhood
-    neighborhood = generate_binary_structure(2,2)
-
-    #apply the local maximum filter; all pixel of maximal value 
-    #in their neighborhood are set to 1
-    local_max = maximum_filter(image, footprint=neighborhood)==image
-    #local_max is a mask that contains the peaks we are 
-    #looking for, but also the background.
-    #In order to isolate the peaks we must remove the background from the mask.
-
-    #we create the mask of the background
-    background = (image==0)
-
-    #a little technicality: we must erode the background in order to 
-    #successfully subtract it form local_max, otherwise a line will 
-    #appear along the background border (artifact of the local maximum filter)
-    eroded_background = binary_erosion(background, structure=neighborhood, border_value=1)
-
-    #we obtain the final mask, containing only peaks, 
-    #by removing the background from the local_max mask (xor operation)
-    detected_peaks = local_max ^ eroded_background
-
-    return detected_peaks
-
-
 def pil_to_bytes(pil_img):
     buf = BytesIO()
-    pil_img.save(buf, format="PNG")
+    to_pil(pil_img).save(buf, format="PNG")
     return buf.getvalue()
 
 def bytes_to_pil(bytes):
@@ -62,40 +27,52 @@ def cv_to_pil(cv_img):
     assert cv_img.shape[2] == 3
     return Image.fromarray(cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB))
 
-def extract_alpha(pil_img):
-    if pil_img.mode[-1] == "A":
-        split = cv2.split(np.array(pil_img))
-        if len(split) == 2:
-            return (cv_to_pil(split[0]), cv_to_pil(split[1]))
-        else:
-            return (cv_to_pil(cv2.merge(split[:-1])), cv_to_pil(split[-1]))
-    else:
-        return (pil_img, None)
+# Single pass SSIM over all channels with the parameters of skimage's structural_similarity
+# defaults for uint8 input (7x7 uniform window, sample covariance, data range 255).
+# Scores stay within 1e-4 of skimage's per channel results.
+SSIM_WIN_SIZE = 7
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+SSIM_COV_NORM = SSIM_WIN_SIZE ** 2 / (SSIM_WIN_SIZE ** 2 - 1)
 
-def weighted_mchan_op_cv(cv_image_a, cv_image_b, op, weights=None):
-    if len(cv_image_a.shape) == 2:
-        assert len(cv_image_b.shape) == 2
-        return op(cv_image_a, cv_image_b)
-    assert cv_image_a.shape[2] == cv_image_b.shape[2]
+def _ssim_filter(image):
+    return cv2.boxFilter(image, -1, (SSIM_WIN_SIZE, SSIM_WIN_SIZE), borderType=cv2.BORDER_REFLECT)
 
-    if weights is None:
-        weights = [1.0] * cv_image_a.shape[2]
+# Statistics of the image that do not depend on what it is compared to,
+# cache them for stored references
+def ssim_stats(cv_image):
+    image = cv_image.astype(np.float32)
+    mean = _ssim_filter(image)
+    var = SSIM_COV_NORM * (_ssim_filter(image * image) - mean * mean)
+    return (image, mean, var)
 
-    results = []
-    for chan_a, chan_b, weight in zip(cv2.split(cv_image_a), cv2.split(cv_image_b), weights):
-        results.append(op(chan_a, chan_b) * weight)
-    return  sum(results) / sum(weights)
+def ssim_stats_cv(cv_image_a, stats_b, weights=None):
+    image_b, mean_b, var_b = stats_b
+    assert cv_image_a.shape == image_b.shape
+    # Like skimage, no score without a whole window in the image
+    if min(cv_image_a.shape[:2]) < SSIM_WIN_SIZE:
+        raise ValueError("SSIM window of {0}x{0} exceeds image of {1}x{2}".format(SSIM_WIN_SIZE, *cv_image_a.shape[:2]))
+    image_a, mean_a, var_a = ssim_stats(cv_image_a)
+    cov = SSIM_COV_NORM * (_ssim_filter(image_a * image_b) - mean_a * mean_b)
+    s_map = ((2 * mean_a * mean_b + SSIM_C1) * (2 * cov + SSIM_C2)) / \
+        ((mean_a * mean_a + mean_b * mean_b + SSIM_C1) * (var_a + var_b + SSIM_C2))
+    pad = (SSIM_WIN_SIZE - 1) // 2
+    s_map = s_map[pad:-pad, pad:-pad]
+    if len(s_map.shape) == 2:
+        return float(s_map.mean(dtype=np.float64))
+    chan_means = s_map.reshape(-1, s_map.shape[2]).mean(axis=0, dtype=np.float64)
+    if weights is None:
+        return float(chan_means.mean())
+    weights = np.asarray(weights, dtype=np.float64)
+    return float((chan_means * weights).sum() / weights.sum())
 
 def ssim_mchan_cv(cv_image_a, cv_image_b, weights=None):
-    assert cv_image_a.shape == cv_image_b.shape
-    return weighted_mchan_op_cv(cv_image_a, cv_image_b, structural_similarity, weights)
+    assert len(cv_image_a.shape) == 3
+    return ssim_cv(cv_image_a, cv_image_b, weights)
 
 def ssim_cv(cv_image_a, cv_image_b, weights=None):
     assert cv_image_a.shape == cv_image_b.shape
-    if len(cv_image_a.shape) == 2:
-        return structural_similarity(cv_image_a, cv_image_b)
-    assert len(cv_image_a.shape) == 3
-    return ssim_mchan_cv(cv_image_a, cv_image_b, weights)
+    return ssim_stats_cv(cv_image_a, ssim_stats(cv_image_b), weights)
 
 def ssim(pil_image_a, pil_image_b, weights=None):
     return ssim_cv(pil_to_cv(pil_image_a), pil_to_cv(pil_image_b), weights)
@@ -107,6 +84,47 @@ def binarize(pil_image, threshold):
 def binarize_cv(cv_image, threshold):
     return cv2.threshold(cv_image, threshold, 255, cv2.THRESH_BINARY)[1]
 
+# Same fixed point ITU-R 601-2 luma transform as PIL's convert("L")
+def luma_cv(cv_image):
+    if len(cv_image.shape) == 2:
+        return cv_image
+    b, g, r = [c.astype(np.uint32) for c in cv2.split(cv_image)[:3]]
+    return ((r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16).astype(np.uint8)
+
+# Same as Image.composite(image, black, mask)
+def apply_mask_cv(cv_image, mask):
+    if len(cv_image.shape) == 3:
+        mask = mask[:, :, None]
+    return ((cv_image.astype(np.uint32) * mask + 127) // 255).astype(np.uint8)
+
+# Numpy equivalent of the composite/binarize/canny chain applied to PIL crops
+def preprocess_cv(cv_image, mask=None, threshold=None, canny_args=None):
+    if mask is not None:
+        cv_image = apply_mask_cv(cv_image, mask)
+    if threshold:
+        cv_image = binarize_cv(luma_cv(cv_image), threshold)
+    if canny_args:
+        cv_image = cv2.Canny(cv_image, *canny_args)
+    return cv_image
+
+def to_pil(image):
+    if isinstance(image, np.ndarray):
+        return cv_to_pil(image)
+    if isinstance(image, Image.Image):
+        return image
+    return image.to_pil()
+
+# PIL image, cv array or Frame -> cv array of the (x0, y0, x1, y1) crop, a view where possible
+def as_cv(image, crop=None):
+    if isinstance(image, np.ndarray):
+        if crop is None:
+            return image
+        x0, y0, x1, y1 = crop
+        return image[y0:y1, x0:x1]
+    if isinstance(image, Image.Image):
+        return pil_to_cv(image.crop(crop) if crop else image)
+    return image.bgr(crop)
+
 def gray_cv(cv_image):
     return cv2.cvtColor(cv_image, cv2.COLOR_BGR2GRAY)
 
@@ -120,20 +138,40 @@ def color_distance_cv(cv_image, color):
     diff = np.sqrt(sum(diff_square_chans)) * 255 / 442
     return diff.astype(np.uint8)
 
-def ocr_text(pil_image, threshold=200, lang="chi_sim", config=None):
-    binary = binarize(pil_image, threshold)
-    binary_a = np.array(binary)
-    n_w = np.sum(binary_a == 255)
-    n_b = binary_a.size - n_w
-    if config == None:
-        config = "--psm 7"
+# Binarized crop with dark text on a white background, as fed to tesseract
+def ocr_binary(image, threshold=200):
+    cv_image = image if isinstance(image, np.ndarray) else pil_to_cv(image)
+    binary = binarize_cv(luma_cv(cv_image), threshold)
+    n_w = np.count_nonzero(binary)
+    n_b = binary.size - n_w
     if n_w > n_b:
-        return image_to_string(binary, lang=lang, config=config)
+        return binary
     else:
-        return image_to_string(ImageOps.invert(binary), lang=lang, config=config)
+        return 255 - binary
 
-def find_floats(pil_image, crop, shape, reference_color=None, threshold=150, canny_args=None, kernel=5, repeat=None):
-    cropped = pil_image.crop(crop)
+def ocr_binary_text(binary, lang="chi_sim", config=None):
+    if config == None:
+        config = "--psm 7"
+    return ocr_engine.recognize(binary, lang, config)
+
+# -> whether binaries read with config are read in one batch, only through pytesseract,
+# which starts a tesseract process per call
+def ocr_batchable(config=None):
+    if config == None:
+        config = "--psm 7"
+    return not ocr_engine.in_process(config)
+
+# -> texts of the binaries, read in one batch
+def ocr_binary_texts(binaries, lang="chi_sim", config=None):
+    if config == None:
+        config = "--psm 7"
+    return ocr_engine.recognize_batch(binaries, lang, config)
+
+def ocr_text(image, threshold=200, lang="chi_sim", config=None):
+    return ocr_binary_text(ocr_binary(image, threshold), lang, config)
+
+def find_floats(image, crop, shape, reference_color=None, threshold=150, canny_args=None, kernel=5, repeat=None):
+    cropped = as_cv(image, crop)
     dx, dy, _, _ = crop
     inner_floats = filter_shapes(find_shapes(cropped, reference_color, threshold, canny_args, kernel), *shape)
     floats = list(map(lambda t: (t[0]+dx, t[1]+dy, t[2], t[3]), inner_floats))
@@ -146,24 +184,118 @@ def find_floats(pil_image, crop, shape, reference_color=None, threshold=150, can
         floats = list(map(lambda xy: (xy[0], xy[1], w, h), expanded_x_y))
     return floats
 
-def match_sub_image(pil_image, sub_images, crop=None, method=cv2.TM_CCOEFF_NORMED, match_th=0.2, ssim_th=0.6, weights=(1.0, 1.0, 1.0)):
-    if crop:
-        target_image = pil_image.crop(crop)
+def phase_correlate_cv(gray_a, gray_b):
+    window = cv2.createHanningWindow((gray_a.shape[1], gray_a.shape[0]), cv2.CV_32F)
+    return cv2.phaseCorrelate(np.float32(gray_a), np.float32(gray_b), window)
+
+# -> (part of gray_a, part of gray_b) showing the same content when that of gray_b moved by (dx, dy)
+def overlap_cv(gray_a, gray_b, dx, dy):
+    h, w = gray_a.shape[:2]
+    return (gray_a[max(-dy, 0):h - max(dy, 0), max(-dx, 0):w - max(dx, 0)],
+        gray_b[max(dy, 0):h - max(-dy, 0), max(dx, 0):w - max(-dx, 0)])
+
+# Displacement of the content of gray_b relative to the equally sized gray_a, by phase correlation.
+# Correlation is cyclic and list entries repeat, so when expected is given only the residual of the
+# windows overlapping at the expected displacement is measured, falling back to the whole crops.
+# Of the estimates reaching min_response, the one the crops aligned by differ least at is kept if they
+# differ by at most max_residual on average, a list stopping short of the expected displacement
+# otherwise aliases to a multiple of its entries.
+# -> ((dx, dy) or None if no estimate reaches min_response and aligns, response), (0, 0) when the crops are unchanged
+def estimate_shift_cv(gray_a, gray_b, expected=(0, 0), min_response=0.1, max_diff=2.0, max_residual=12.0):
+    if cv2.absdiff(gray_a, gray_b).mean() <= max_diff:
+        return ((0, 0), 1.0)
+    h, w = gray_a.shape[:2]
+    ex, ey = int(round(expected[0])), int(round(expected[1]))
+    estimates = []
+    if (ex or ey) and abs(ex) <= w * 3 // 4 and abs(ey) <= h * 3 // 4:
+        (dx, dy), response = phase_correlate_cv(*overlap_cv(gray_a, gray_b, ex, ey))
+        estimates.append(((ex + dx, ey + dy), response))
+    estimates.append(phase_correlate_cv(gray_a, gray_b))
+    best = (None, max(response for _, response in estimates))
+    best_residual = max_residual
+    for shift, response in estimates:
+        dx, dy = int(round(shift[0])), int(round(shift[1]))
+        if response < min_response or abs(dx) >= w or abs(dy) >= h:
+            continue
+        residual = cv2.absdiff(*overlap_cv(gray_a, gray_b, dx, dy)).mean()
+        if residual <= best_residual:
+            best, best_residual = (shift, response), residual
+    return best
+
+# Correlates every template against the target with the target's channels split once,
+# -> [weighted average of the per channel match results] in template order
+def match_templates_cv(cv_image, templates, method=cv2.TM_CCOEFF_NORMED, weights=None):
+    if len(cv_image.shape) == 2:
+        return [cv2.matchTemplate(cv_image, template, method) for template in templates]
+    chans = cv2.split(cv_image)
+    if weights is None:
+        weights = [1.0] * len(chans)
+    results = []
+    for template in templates:
+        result = None
+        for chan, template_chan, weight in zip(chans, cv2.split(template), weights):
+            chan_result = cv2.matchTemplate(chan, template_chan, method)
+            if weight != 1.0:
+                chan_result *= weight
+            result = chan_result if result is None else cv2.add(result, chan_result)
+        results.append(result / sum(weights))
+    return results
+
+# Local maxima over the 8-connected neighbourhood (or a size=(w, h) one) that reach threshold
+# -> [(x, y)] in row-major order
+def find_peaks(scores, threshold, size=(3, 3)):
+    dilated = cv2.dilate(scores, np.ones(size[::-1], np.uint8))
+    ys, xs = np.nonzero((scores >= threshold) & (scores >= dilated))
+    return list(zip(xs.tolist(), ys.tolist()))
+
+def pyramid_down(cv_image, levels):
+    for _ in range(levels):
+        cv_image = cv2.pyrDown(cv_image)
+    return cv_image
+
+# Correlates at 1/2**levels resolution first, then only around the coarse peaks at full resolution
+# -> [[(x, y)] peaks] in template order
+def match_templates_pyramid_cv(cv_image, templates, method=cv2.TM_CCOEFF_NORMED, weights=None,
+        match_th=0.2, levels=1, refine=4, coarse_th=None):
+    if coarse_th is None:
+        coarse_th = match_th
+    scale = 2 ** levels
+    height, width = cv_image.shape[:2]
+    coarse_results = match_templates_cv(pyramid_down(cv_image, levels),
+        [pyramid_down(template, levels) for template in templates], method, weights)
+    peaks = []
+    for template, coarse in zip(templates, coarse_results):
+        th, tw = template.shape[:2]
+        template_peaks = set()
+        # Matches of one template cannot be closer than its size, so suppress weaker coarse peaks within it
+        for cx, cy in find_peaks(coarse, coarse_th, (max(tw // scale, 3), max(th // scale, 3))):
+            x0, y0 = max(cx * scale - refine, 0), max(cy * scale - refine, 0)
+            x1, y1 = min(cx * scale + refine + scale, width - tw), min(cy * scale + refine + scale, height - th)
+            if x1 < x0 or y1 < y0:
+                continue
+            window = match_templates_cv(cv_image[y0:y1+th, x0:x1+tw], [template], method, weights)[0]
+            _, max_val, _, (mx, my) = cv2.minMaxLoc(window)
+            if max_val >= match_th:
+                template_peaks.add((x0 + mx, y0 + my))
+        peaks.append(sorted(template_peaks, key=lambda p: (p[1], p[0])))
+    return peaks
+
+def match_sub_image(target, sub_images, crop=None, method=cv2.TM_CCOEFF_NORMED, match_th=0.2, ssim_th=0.6, weights=(1.0, 1.0, 1.0),
+        pyramid=0, refine=4, coarse_th=None):
+    image = as_cv(target, crop)
+    templates = [sub_image if isinstance(sub_image, np.ndarray) else pil_to_cv(sub_image) for sub_image in sub_images]
+    if pyramid:
+        peaks = match_templates_pyramid_cv(image, templates, method, weights, match_th, pyramid, refine, coarse_th)
     else:
-        target_image = pil_image
+        peaks = [find_peaks(match_results, match_th) for match_results in match_templates_cv(image, templates, method, weights)]
     results = []
-    for sub_image in sub_images:
-        image = pil_to_cv(target_image)
-        template = pil_to_cv(sub_image)
-        match_op = lambda i, t: cv2.matchTemplate(i, t, method)
-        match_results = weighted_mchan_op_cv(image, template, match_op, weights)
-        peak_location = set(zip(*np.where(detect_peaks(match_results))[::-1]))
-        threshold_location = set(zip(*np.where(match_results >= match_th)[::-1]))
-        result = [(x, y, sub_image.width, sub_image.height) for x,y in peak_location.intersection(threshold_location)]
+    for template, template_peaks in zip(templates, peaks):
+        height, width = template.shape[:2]
+        result = [(x, y, width, height) for x, y in template_peaks]
         if ssim_th:
-            result = [(ssim(target_image.crop((r[0], r[1], r[0]+r[2], r[1]+r[3])), sub_image), r)
-                for r in result]
-            result = [r[1] for r in result if r[0] >= ssim_th]
+            template_stats = ssim_stats(template)
+            result = [r for r in result
+                if ssim_stats_cv(image[r[1]:r[1]+height, r[0]:r[0]+width], template_stats) >= ssim_th]
         results += result
     if crop:
         results = [(x + crop[0], y + crop[1], w, h) for x, y, w, h in results]
@@ -180,8 +312,8 @@ def expand_to_series(x, w, x_int, x_lower, x_upper):
         return np.array([x])
     
     
-def find_shapes(pil_image, reference_color=None, threshold=150, canny_args=None, kernel=5):
-    cv_img = pil_to_cv(pil_image)
+def find_shapes(image, reference_color=None, threshold=150, canny_args=None, kernel=5):
+    cv_img = as_cv(image)
     if reference_color:
         cv_img = color_distance_cv(cv_img, reference_color)
     else:
@@ -194,8 +326,8 @@ def find_shapes(pil_image, reference_color=None, threshold=150, canny_args=None,
     ctrs, _ = cv2.findContours(cv_img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
     return list(map(lambda x: cv2.boundingRect(x), ctrs))
 
-def draw_shapes(pil_image, shapes):
-    drawn = pil_image.copy()
+def draw_shapes(image, shapes):
+    drawn = to_pil(image).convert("RGB")
     draw = ImageDraw.Draw(drawn)
     for rect in shapes:
         x, y, w, h = rect
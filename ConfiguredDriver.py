@@ -1,4 +1,5 @@
 from ArkDriver.Driver import ArkDriver
+from ArkDriver.SanityClock import SanityClock
 from time import sleep, time
 from datetime import datetime
 from random import randint
@@ -13,21 +14,39 @@ class Unsupported(Exception):
     def __init__(self, *args, **argv):
         super().__init__(*args, **argv)
 
+NAVIGABLE_STATES = ["main.settings", "menu.main", "menu", "back", "in_battle.enemy_icon", "battle_finished.title"]
+POPUP_STATES = ["communicating", "popup.loading", "popup.got_rewards", "popup.signin.close",
+    "popup.announcement.close", "popup.relogin.reauth", "popup.error.autopilot_sync_failure",
+    "popup.generic_info.confirm"]
+LOGIN_STATES = ["login.start", "popup.relogin.outdated"]
+
 class ConfiguredDriver(ArkDriver):
     def __init__(self, *args, **argv):
         super().__init__(*args, **argv)
         self.load_from_file()
+        self._dev.start_capture_pipeline()
         self.current_san = 0
         self.current_cost = 0
         self.current_map_name = ""
         self.current_map_name_chi = ""
+        self.sanity = SanityClock()
+        self.plan_states = {}
         self.exc_log = {}
         self.exc_full_log = []
 
+    # Stops the capture pipeline, the driver captures on demand afterwards
+    def close(self):
+        self._dev.stop_capture_pipeline()
+
     def dump_exc_full_log(self, fn="exc_full_log.data"):
         with open(fn, "wb") as f:
             pickle.dump(self.exc_full_log, f)
 
+    # -> condition that the popup is gone, leaving a screen handle_popup knows how to deal with
+    def popup_closed(self, name):
+        return lambda: not self.validate_component(name) and \
+            (self.is_navigable() or bool(self.classify(POPUP_STATES, first=True)))
+
     def handle_popup(self, delay=15, retries=3, retry_intern=5):
         print("- Handling possible popups")
         handled = False
@@ -35,30 +54,31 @@ class ConfiguredDriver(ArkDriver):
 
         count = 0
         while not self.is_navigable():
+            # All matches, so the popups are handled in the order below whatever the checks cost
+            matched = self.classify(POPUP_STATES)
             # Communication stuck
-            if self.validate_component("communicating"):
+            if "communicating" in matched:
                 handled = True
-                print("  Communicating, wait for {} secs".format(delay))
-                sleep(delay)
-                self.refresh_screen()
+                print("  Communicating, wait for up to {} secs".format(delay))
+                self.wait_communicating(delay)
                 continue
-            if self.tap_refresh_component("popup.loading", delay):
+            if "popup.loading" in matched and self.tap_refresh_component("popup.loading", delay, self.popup_closed("popup.loading")):
                 handled = True
                 print("  Handled loading popup")
                 continue
-            if self.tap_refresh_component("popup.got_rewards", delay):
+            if "popup.got_rewards" in matched and self.tap_refresh_component("popup.got_rewards", delay, self.popup_closed("popup.got_rewards")):
                 handled = True
                 print("  Handled rewards popup")
                 continue
-            if self.tap_refresh_component("popup.signin.close", delay):
+            if "popup.signin.close" in matched and self.tap_refresh_component("popup.signin.close", delay, self.popup_closed("popup.signin.close")):
                 handled = True
                 print("  Handled signin popup")
                 continue
-            if self.tap_refresh_component("popup.announcement.close", delay):
+            if "popup.announcement.close" in matched and self.tap_refresh_component("popup.announcement.close", delay, self.popup_closed("popup.announcement.close")):
                 handled = True
                 print("  Handled announcement popup")
                 continue
-            if self.validate_component("popup.relogin.reauth"):
+            if "popup.relogin.reauth" in matched:
                 handled = True
                 print("  Re-login needed, triggering")
                 if not self.tap_refresh_component("popup.generic_info.confirm", delay):
@@ -66,14 +86,14 @@ class ConfiguredDriver(ArkDriver):
                 if not self.re_login():
                     raise UnexpectedState()
                 continue
-            if self.validate_component("popup.error.autopilot_sync_failure"):
+            if "popup.error.autopilot_sync_failure" in matched:
                 handled = True
                 print("  Auth may be outdated, trying to go to base to trigger a refresh")
                 if not self.tap_refresh_component("popup.generic_info.confirm", delay):
                     raise UnexpectedState()
                 self.goto_base()
                 continue
-            if self.tap_refresh_component("popup.generic_info.confirm", delay):
+            if "popup.generic_info.confirm" in matched and self.tap_refresh_component("popup.generic_info.confirm", delay, self.popup_closed("popup.generic_info.confirm")):
                 handled = True
                 print("  Handled an unknown generic info popup")
                 continue
@@ -81,19 +101,16 @@ class ConfiguredDriver(ArkDriver):
             if count >= retries:
                 break
             count += 1
-            print("  Waiting {} secs before next try".format(retry_intern))
-            sleep(retry_intern)
-            self.refresh_screen()
+            print("  Waiting up to {} secs before next try".format(retry_intern))
+            self.wait_for(NAVIGABLE_STATES + POPUP_STATES, retry_intern)
 
         return handled
 
     def is_navigable(self):
-        return self.validate_component("main.settings") \
-            or self.validate_component("menu.main") \
-            or self.validate_component("menu") \
-            or self.validate_component("back") \
-            or self.validate_component("in_battle.enemy_icon") \
-            or self.validate_component("battle_finished.title")
+        return bool(self.classify(NAVIGABLE_STATES, first=True))
+
+    def wait_communicating(self, timeout):
+        return self.wait_for(lambda: not self.validate_component("communicating"), timeout, watch=["communicating"])
     
     # -> None: Successful recovery
     # -> Others: Failure to recover, should raise return value immediately
@@ -121,13 +138,16 @@ class ConfiguredDriver(ArkDriver):
         count += 1
         self.exc_log[(filename, lineno)] = count
         print("  Waiting for {} secs before attempting recovery".format(retry_intern))
-        sleep(retry_intern)
+        with self._dev.capture_paused():
+            sleep(retry_intern)
         return None
 
     def interrupt_user(self, check_intern=30):
-        while self.is_in_battle():
-            print("  Navigation: wait {} secs for running battle".format(check_intern))
-            sleep(check_intern)
+        if self.is_in_battle():
+            print("  Navigation: waiting for running battle")
+            _, elapsed = self.wait_for(lambda: not self.validate_component("in_battle.enemy_icon"),
+                max_interval=check_intern, watch=["in_battle.enemy_icon"])
+            print("  Battle left after {:.0f} secs".format(elapsed))
         if self.tap_battle_finished():
             print("  Leaving battle finished page")
 
@@ -137,10 +157,11 @@ class ConfiguredDriver(ArkDriver):
 
         count = 0
         while not self.is_navigable():
-            if self.tap_refresh_component("login.start", delay):
+            matched = self.classify(LOGIN_STATES, first=True)
+            if "login.start" in matched and self.tap_refresh_component("login.start", delay):
                 print("  Logged in")
                 continue
-            if self.validate_component("popup.relogin.outdated"):
+            if "popup.relogin.outdated" in matched:
                 if not self.tap_refresh_component("popup.generic_info.confirm", delay):
                     raise UnexpectedState()
                 print("  Updating data")
@@ -150,9 +171,9 @@ class ConfiguredDriver(ArkDriver):
                 continue
             if count >= max_check:
                 return False
-            print(" Waiting {} secs for login process : {}/{}".format(check_intern, count+1, max_check))
+            print(" Waiting up to {} secs for login process : {}/{}".format(check_intern, count+1, max_check))
             count += 1
-            sleep(check_intern)
+            self.wait_for(NAVIGABLE_STATES + LOGIN_STATES + POPUP_STATES, check_intern)
         return True
 
 
@@ -162,56 +183,43 @@ class ConfiguredDriver(ArkDriver):
         print("- Navigating to main page")
         self.refresh_screen()
         while True:
-            while self.validate_component("communicating"):
-                print("  Communicating, wait for {} secs".format(delay))
-                sleep(delay)
-                self.refresh_screen()
-            if self.tap_refresh_component("menu.main", delay):
-                continue 
-            if self.tap_refresh_component("menu") and \
-                self.tap_refresh_component("menu.main", delay):
-                continue 
-            if self.tap_refresh_component("back"):
-                continue
-            if self.validate_component("main.settings"):
+            if self.goto("main", delay):
                 return True
+            # Off the navigation graph
+            matched = self.classify(["communicating", "back"])
+            if "communicating" in matched:
+                print("  Communicating, wait for up to {} secs".format(delay))
+                self.wait_communicating(delay)
+                continue
+            if "back" in matched and self.tap_refresh_component("back", until=self.locate_page):
+                continue
             return False
 
-    def goto_missions(self):
+    # Goes to a page of the navigation graph, through the main page when
+    # there is no route from the current screen
+    def navigate(self, page, delay=15):
         self.refresh_screen()
-        if self.validate_component("missions.main_story.inner"):
+        if self.goto(page, delay):
             return True
-        if not self.home():
-            return False
+        print("  No route from the current screen, going through main page")
+        return self.home(delay) and self.goto(page, delay)
+
+    def goto_missions(self):
         print("- Navigating to missions page")
-        if not self.ensure_tap("main.missions", "missions.main_story.inner"):
-            return False
-        return True
+        return self.navigate("missions")
 
     def goto_base(self, delay=15):
-        self.refresh_screen()
-        if self.validate_component("base.main.overview"):
-            return True
         print("- Navigating to base page")
-        if self.ensure_tap("menu.base", "base.main.overview", delay):
-            return True
-        if self.ensure_tap("menu", "menu.base") and \
-            self.ensure_tap("menu.base", "base.main.overview", delay):
-            return True
-        print("  Through main page")
-        if not self.home():
-            return False
-        print("  Now from main to base")
-        if self.ensure_tap("main.base", "base.main.overview", delay):
-            return True
-        return False
+        return self.navigate("base", delay)
 
-    def ensure_tap(self, tap, next_page, delay=2.5):
-        while True:
-            if not self.tap_refresh_component(tap, delay):
+    # delay: the longest wait for next_page after each tap, retries: taps before giving up
+    def ensure_tap(self, tap, next_page, delay=2.5, retries=3):
+        for _ in range(retries):
+            if not self.tap_component(tap):
                 return False
-            if self.validate_component(next_page):
+            if self.wait_for([next_page], delay)[0]:
                 return True
+        return False
 
     def is_in_battle(self):
         self.refresh_screen()
@@ -225,8 +233,10 @@ class ConfiguredDriver(ArkDriver):
         self.refresh_screen()
         if not self.validate_component("battle_finished.title"):
             return False
-        sleep(wait)
-        self.tap_refresh_component("battle_finished.title", delay=15)
+        with self._dev.capture_paused():
+            sleep(wait)
+        self.tap_refresh_component("battle_finished.title", delay=15,
+            until=lambda: not self.validate_component("battle_finished.title"))
         return True
     
     def tap_prepare_battle(self):
@@ -245,11 +255,23 @@ class ConfiguredDriver(ArkDriver):
             self.current_map_name = info[1]
             try:
                 self.current_cost = int(info[2].strip("-"))
-                self.current_san = int(info[3].split("/")[0])
+                san = info[3].split("/")
+                self.current_san = int(san[0])
+                san_max = int(san[1]) if len(san) > 1 else None
             except ValueError:
                 return False
+            if self.uses_sanity(self.current_map_name):
+                self.sanity.read(self.current_san, san_max)
+            costs = self.stats.setdefault("map_costs", {})
+            if costs.get(self.current_map_name, None) != self.current_cost:
+                costs[self.current_map_name] = self.current_cost
+                self.save_stats()
             return True
         return False
+
+    # Obsidian Festival stages cost their own tickets, which do not regenerate
+    def uses_sanity(self, map_name):
+        return not map_name.startswith("OF-F")
     
     def goto_map(self, map_name):
         if self.refresh_map_info():
@@ -257,24 +279,17 @@ class ConfiguredDriver(ArkDriver):
                 print("  Currently already on map {}, skipping navigation".format(map_name))
                 return
 
-        if not self.goto_missions():
-            raise UnexpectedState()
-
         print("- Navigating to map {}".format(map_name))
         # Obsidian Festival Retrospect
         if map_name.startswith("OF-"):
-            if not self.ensure_tap("missions.of_r", "missions.of_r.main"):
+            page = "of_r.maps.fest" if map_name.startswith("OF-F") else "of_r.maps.main"
+            if not self.navigate(page):
                 raise UnexpectedState()
-            if map_name.startswith("OF-F"):
-                if not self.ensure_tap("missions.of_r.fest", "missions.of_r.maps.fest.selected"):
-                    raise UnexpectedState()
-            else:
-                if not self.ensure_tap("missions.of_r.main", "missions.of_r.maps.main.selected"):
-                    raise UnexpectedState()
-            search_result = self.search("maps.map_entry", lambda r: (r[0] and map_name in r[0]) or (r[1] and map_name in r[1]))
+            search_result = self.search_located("maps.map_entry", lambda r: (r[0] and map_name in r[0]) or (r[1] and map_name in r[1]),
+                page, map_name)
             if len(search_result) != 1:
                 raise UnexpectedState()
-            self.tap_refresh(*search_result[0][2])
+            self.tap_refresh(*search_result[0][2], until=lambda: self.validate_component("map_selected.start"))
             if not self.refresh_map_info():
                 raise UnexpectedState()
             if self.current_map_name != map_name:
@@ -283,14 +298,13 @@ class ConfiguredDriver(ArkDriver):
         raise Unsupported()
 
 
+    # -> number of battles run
     def farm_map(self, map_name, times=None, sanity_recovery=True,
-        check_intern=30,
+        check_intern=30, battle_check_dense=5,
         battle_finish_wait_time=(10, 70),
         recovery_wait_time=(30, 600),
         retries=5, retry_intern=15):
-        # Special cases
-        # Force sanity recovery off for Obsidian Festival stages
-        if map_name.startswith("OF-F"):
+        if not self.uses_sanity(map_name):
             sanity_recovery = False
 
         count = 0
@@ -299,30 +313,40 @@ class ConfiguredDriver(ArkDriver):
             print("- Farming {} {}: Round {}/{}".format(self.current_map_name, self.current_map_name_chi, count + 1, times if times else "INF"))
             print("  Current san: {} / Needed: {}".format(self.current_san, self.current_cost))
             if self.current_san < self.current_cost:
-                if sanity_recovery:
-                    wait_min = (self.current_cost - self.current_san) * 6 
-                    print("  Not enough san, waiting for recovery: ", wait_min, "min")
-                    recovery_wait_sec = randint(*recovery_wait_time)
-                    print("  Adding {} secs as additional recovery time".format(recovery_wait_sec))
-                    wait_sec = 60 * wait_min + recovery_wait_sec
-                    next_run_ts = int(time()) + wait_sec
-                    print("- Next scheduled check time: ", datetime.fromtimestamp(next_run_ts))
-                    sleep(wait_sec)
+                ready_ts = self.sanity.ready_at(self.current_cost)
+                if sanity_recovery and ready_ts is not None:
+                    print("  Not enough san, waiting for recovery")
+                    self.sleep_until(ready_ts, recovery_wait_time)
                     continue
-                else:
-                    print("- San used up")
-                    return
+                print("- San used up")
+                return count
             if not self.tap_prepare_battle():
                 raise UnexpectedState()
             if not self.tap_start_battle():
                 raise UnexpectedState()
+            if self.uses_sanity(map_name):
+                self.sanity.spend(self.current_cost)
 
             print("  Battle started")
+            battle_start = time()
+            recorded = False
             failure_timer = 0
             while True:
                 if self.is_in_autopilot_battle():
-                    print("  Battle still running, wait {} secs".format(check_intern))
-                    sleep(check_intern)
+                    window = self.battle_timer.window(self.current_map_name)
+                    if window:
+                        print("  Battle running, expected to finish after {:.0f}-{:.0f} secs".format(*window))
+                    else:
+                        print("  Battle running, polling every {} secs".format(check_intern))
+                    schedule = self.battle_timer.schedule(self.current_map_name, check_intern, battle_check_dense)
+                    self.wait_for(lambda: not self.validate_component("in_battle.autopilot.take_over"),
+                        watch=["in_battle.autopilot.take_over"],
+                        schedule=lambda elapsed: schedule(time() - battle_start))
+                    print("  Battle left after {:.0f} secs".format(time() - battle_start))
+                    if not recorded:
+                        self.battle_timer.record(self.current_map_name, time() - battle_start)
+                        self.save_stats()
+                        recorded = True
                     continue
                 if battle_finish_wait_time:
                     wait_secs = randint(*battle_finish_wait_time)
@@ -337,12 +361,113 @@ class ConfiguredDriver(ArkDriver):
                     if failure_timer >= retries:
                         raise UnexpectedState()
                     failure_timer += 1
-                    print("  Retrying after {} secs".format(retry_intern))
-                    sleep(retry_intern)
+                    print("  Retrying within {} secs".format(retry_intern))
+                    self.wait_for(["battle_finished.title"], retry_intern)
             count += 1
             if times and count >= times:
                 print("- Farm Finished")
-                return
-    
+                return count
 
+    # Sleeps until ts, plus a random extra_wait_time secs
+    def sleep_until(self, ts, extra_wait_time=None):
+        wait_sec = max(ts - time(), 0)
+        if extra_wait_time:
+            wait_sec += randint(*extra_wait_time)
+        print("- Next scheduled check time: ", datetime.fromtimestamp(int(time() + wait_sec)))
+        with self._dev.capture_paused():
+            sleep(wait_sec)
+
+    # -> int value of a plan condition's query, read on its map when it is not on screen
+    def read_plan_value(self, cond):
+        self.refresh_screen()
+        result = self.query_set(cond["query"])
+        if not result and "map" in cond:
+            self.goto_map(cond["map"])
+            result = self.query_set(cond["query"])
+        try:
+            return int(result[cond.get("index", 0)])
+        except (TypeError, IndexError, ValueError):
+            raise UnexpectedState()
 
+    # -> whether the values of the job's conditions are in range, values: {(query, index): value} read
+    # so far, conditions are read in order up to the first one out of range
+    def plan_conditions_met(self, job, values):
+        for cond in job.get("when", []):
+            key = (cond["query"], cond.get("index", 0))
+            if key not in values:
+                values[key] = self.read_plan_value(cond)
+            if values[key] < cond.get("min", values[key]) or values[key] > cond.get("max", values[key]):
+                return False
+        return True
+
+    # -> timestamp the job can run at, None if it cannot run until other jobs have
+    def job_ready_at(self, job, state, total):
+        if not self.uses_sanity(job["map"]):
+            if state["exhausted_at"] is not None and total - state["exhausted_at"] < job.get("retry_after", 1):
+                return None
+            return time()
+        cost = self.stats.get("map_costs", {}).get(job["map"], None)
+        # Unknown costs and sanity are read on the map
+        if cost is None or self.sanity.value() is None:
+            return time()
+        return self.sanity.ready_at(cost)
+
+    # Runs the jobs of config["farm_plans"][name] one battle at a time until none of them can run any more.
+    #   jobs:
+    #   - map: <map name>
+    #     priority: <higher runs first, default 0>
+    #     runs: <battles to run, default unlimited>
+    #     retry_after: <for maps without sanity cost, battles of other jobs before
+    #       trying again when out of tickets, default 1>
+    #     when: [{query: <query set>, index: <default 0>, map: <where it is read when not on screen>, min: , max: }]
+    #     changes: <query sets of conditions the job's battles change, default all>
+    # Of the jobs that can run now, the one with the highest priority runs, except that sanity is saved
+    # for the highest priority job using it. Sanity is tracked from the map info readings, when no job
+    # is ready the driver sleeps until the sanity for that job has regenerated.
+    # Jobs are checked in priority order up to the first one ready, conditions are read only for the jobs
+    # checked and their values kept until a job that changes them has run.
+    # Progress is kept across calls interrupted by exceptions.
+    def run_plan(self, name, wake_wait_time=(30, 120)):
+        jobs = self.config["farm_plans"][name]["jobs"]
+        states = self.plan_states.setdefault(name, [{"runs": 0, "exhausted_at": None} for _ in jobs])
+        values = {}
+        while True:
+            total = sum(state["runs"] for state in states)
+            chosen = None
+            wake_ts = None
+            sanity_saved = False
+            for job, state in sorted(zip(jobs, states), key=lambda j: -j[0].get("priority", 0)):
+                if job.get("runs", None) is not None and state["runs"] >= job["runs"]:
+                    continue
+                if sanity_saved and self.uses_sanity(job["map"]):
+                    continue
+                if not self.plan_conditions_met(job, values):
+                    continue
+                ts = self.job_ready_at(job, state, total)
+                if ts is not None and ts <= time():
+                    chosen = (job, state)
+                    break
+                if ts is not None:
+                    wake_ts = ts if wake_ts is None else min(wake_ts, ts)
+                if self.uses_sanity(job["map"]):
+                    sanity_saved = True
+            if chosen is None:
+                if wake_ts is None:
+                    print("- Farm plan {} finished".format(name))
+                    del self.plan_states[name]
+                    return
+                print("- Farm plan {}: waiting for san".format(name))
+                self.sleep_until(wake_ts, wake_wait_time)
+                continue
+            job, state = chosen
+            count = self.farm_map(job["map"], times=1, sanity_recovery=False)
+            state["runs"] += count
+            if count:
+                state["exhausted_at"] = None
+                self.exc_log.clear()
+                changes = job.get("changes", None)
+                for key in [key for key in values if changes is None or key[0] in changes]:
+                    del values[key]
+            elif not self.uses_sanity(job["map"]):
+                state["exhausted_at"] = total
+            print("- Farm plan {}: {} runs done".format(name, ", ".join("{} {}".format(job["map"], state["runs"]) for job, state in zip(jobs, states))))
@@ -8,7 +8,8 @@ from PIL import Image
 from PIL.ImageOps import crop, invert
 from pytesseract import image_to_string
 from io import BytesIO
-import sh
+from ArkDriver.AdbShell import AdbShell
+from ArkDriver.BattleTimer import BattleTimer
 
 class OCRValidationException(Exception):
     def __init__(self, excepted, got):
@@ -27,7 +28,7 @@ def offset_tap(*s):
 def get_screenshot(dev):
     while True:
         try:
-            sh.adb("shell", "screencap", "-p", "/sdcard/screen.png")
+            AdbShell.for_device(dev).run(["screencap", "-p", "/sdcard/screen.png"])
             img = b''.join(dev.sync.iter_content("/sdcard/screen.png"))
             return BytesIO(img)
         except Exception as e:
@@ -114,7 +115,10 @@ def main():
     parser.add_argument("-n", "--num", dest="num", type=int, default=0, help="Number of runs to perform, 0 for infinite")
     parser.add_argument("-g", "--gap", dest="gap", type=int, default=1, help="Fixed gap time in minutes between iterations")
     parser.add_argument("-R", "--random", dest="random", type=int, default=6, help="Randomized gap time upper bound in minutes between runs")
-    parser.add_argument("-b", "--battle_check_interval", dest="battle_check_interval", type=int, default=1, help="Time in minutes between checks on if the battle has finished")
+    parser.add_argument("-b", "--battle_check_interval", dest="battle_check_interval", type=int, default=1,
+        help="Time in minutes between checks on if the battle has finished, before battle durations are known")
+    parser.add_argument("-B", "--battle_check_dense", dest="battle_check_dense", type=int, default=5,
+        help="Time in seconds between checks around the expected end of the battle")
     parser.add_argument("-t", "--total_time", dest="total_time", type=int, default=0, help="Total time bound in minutes for the whole process")
     parser.add_argument("-r", "--recover_to", dest="recover_to", type=int, default=0,
         help="Wait for sanity to recover to this value before next run when sanity is not enough, put 0 to recover to sanity_per_run")
@@ -125,6 +129,9 @@ def main():
         dev = adb.device(serial=args.serial)
     else:
         dev = adb.device()
+    shell = AdbShell.for_device(dev)
+    # Durations of this session's battles
+    battle_timer = BattleTimer({})
     
     finished_runs = 0
     start_time = int(time())
@@ -144,10 +151,12 @@ def main():
                 print("Running for", finished_runs+1)
 
                 print("Tapping prepare")
-                sh.adb("shell", offset_tap("input", "tap", 1650, 950))
+                shell.run(offset_tap("input", "tap", 1650, 950))
                 sleep(15)
                 print("Tapping start")
-                sh.adb("shell", offset_tap("input", "tap", 1650, 750))
+                shell.run(offset_tap("input", "tap", 1650, 750))
+                battle_start = time()
+                schedule = battle_timer.schedule("battle", args.battle_check_interval * 60, args.battle_check_dense)
                 sleep(30)
 
                 check_failures = 0
@@ -157,20 +166,22 @@ def main():
                     img_obj = Image.open(img)
                     if is_battle_page(img_obj):
                         check_failures = 0
-                        print("Battle running, waiting for", args.battle_check_interval, "min")
-                        sleep(args.battle_check_interval * 60)
+                        wait_sec = schedule(time() - battle_start)
+                        print("Battle running, waiting for {:.0f} secs".format(wait_sec))
+                        sleep(wait_sec)
                         continue
                     if is_result_page(img_obj):
-                        print("Battle finished")
+                        print("Battle finished after {:.0f} secs".format(time() - battle_start))
+                        battle_timer.record("battle", time() - battle_start)
                         break
                     if is_annihilation_summary_page(img_obj):
                         print("Annihilation summary, tapping out")
-                        sh.adb("shell", offset_tap("input", "tap", 1000, 200))
+                        shell.run(offset_tap("input", "tap", 1000, 200))
                         sleep(15)
                         continue
                     if is_currently_on_level_up_page(dev):
                         print("Leveled up, tapping out")
-                        sh.adb("shell", offset_tap("input", "tap", 1000, 200))
+                        shell.run(offset_tap("input", "tap", 1000, 200))
                         sleep(15)
                         continue
                     else:
@@ -184,7 +195,7 @@ def main():
                             sleep(15)
 
                 print("Tapping out")
-                sh.adb("shell", offset_tap("input", "tap", 1000, 200))
+                shell.run(offset_tap("input", "tap", 1000, 200))
 
                 finished_runs += 1
                 print("Run for", finished_runs, "finished")
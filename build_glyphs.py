@@ -0,0 +1,41 @@
+from ArkDriver.Glyphs import build_glyph_data
+from ArkDriver.cvUtils import pil_to_cv, ocr_text
+from argparse import ArgumentParser
+from PIL import Image
+import pickle
+
+
+parser = ArgumentParser()
+parser.add_argument("name", help="Glyph set name in ref data")
+parser.add_argument("samples", nargs="+", help="Screenshot files, append =TEXT to label a sample instead of using tesseract")
+parser.add_argument("-c", "--crop", nargs=4, type=int, required=True, help="Crop of the text field on the screenshots")
+parser.add_argument("-t", "--threshold", type=int, default=200, help="Binarization threshold")
+parser.add_argument("-l", "--lang", default="eng", help="Tesseract language used for labeling")
+parser.add_argument("-a", "--append", action="store_true", default=False, help="Append to an existing glyph set")
+parser.add_argument("-r", "--ref_data", default="ref.data", help="Ref data file to update")
+args = parser.parse_args()
+
+samples = []
+for sample in args.samples:
+    fn, sep, text = sample.rpartition("=")
+    if not sep:
+        fn, text = sample, None
+    cropped = pil_to_cv(Image.open(fn).crop(args.crop))
+    if text is None:
+        text = ocr_text(cropped, args.threshold, args.lang)
+    print("{}: {}".format(fn, text))
+    samples.append((cropped, text, args.threshold))
+
+data, skipped = build_glyph_data(samples)
+for n in skipped:
+    print("Skipped {}: segmentation does not match the text".format(args.samples[n]))
+
+with open(args.ref_data, "rb") as f:
+    ref_data = pickle.load(f)
+glyphs = ref_data.setdefault("glyphs", {})
+if args.append:
+    data = glyphs.get(args.name, []) + data
+glyphs[args.name] = data
+with open(args.ref_data, "wb") as f:
+    pickle.dump(ref_data, f)
+print("Saved {} glyphs for: {}".format(len(data), "".join(sorted(set(label for label, _ in data)))))
@@ -0,0 +1,67 @@
+from ArkDriver.Driver import ArkDriver
+from ArkDriver.Fingerprint import calibrate_fingerprint
+from ArkDriver.Frame import Frame
+from argparse import ArgumentParser
+from PIL import Image
+import numpy as np
+import pickle
+
+
+class ScreenFile(object):
+    def __init__(self):
+        self._frame = None
+
+    def load(self, fn):
+        self._frame = Frame(np.array(Image.open(fn).convert("RGBA")))
+
+    def get_geometry(self):
+        return self._frame.size
+
+    def get_frame(self):
+        return self._frame
+
+    def refresh_screen(self, newer_than=None):
+        return self._frame
+
+
+parser = ArgumentParser(description="Check that component fingerprints never reject a screenshot the full check accepts")
+parser.add_argument("screens", nargs="+", help="Screenshot files")
+parser.add_argument("-c", "--config", default="config.yaml", help="Config file")
+parser.add_argument("-r", "--ref_data", default="ref.data", help="Ref data file")
+parser.add_argument("--calibrate", action="store_true", default=False,
+    help="Widen rejecting fingerprints and learn OCR fingerprints, then save them to the ref data file")
+args = parser.parse_args()
+
+dev = ScreenFile()
+dev.load(args.screens[0])
+driver = ArkDriver(dev)
+driver.load_from_file(args.config, args.ref_data)
+
+positives = {}
+for fn in args.screens:
+    dev.load(fn)
+    driver.refresh_screen()
+    driver.use_fingerprints = False
+    matched = [name for name in driver.config["components"] if driver.validate_component(name)]
+    driver.use_fingerprints = True
+    for name in matched:
+        cropped = driver.component_crop(name)
+        positives.setdefault(name, []).append(cropped)
+        if driver.fingerprint_rejects(name, cropped):
+            print("False reject: {} on {}".format(name, fn))
+
+for name in sorted(driver.config["components"]):
+    fingerprint = driver.refs.fingerprint(name, driver.config["components"][name])
+    crops = positives.get(name, [])
+    worst = max((fingerprint.distance(c) for c in crops), default=None) if fingerprint else None
+    print("{}: {} positives, tolerance {}, worst distance {}".format(name, len(crops),
+        fingerprint.tol if fingerprint else None, worst))
+
+if args.calibrate:
+    fingerprints = driver.ref_data.setdefault("fingerprints", {})
+    for name, crops in positives.items():
+        fingerprint = calibrate_fingerprint(crops, driver.refs.fingerprint(name, driver.config["components"][name]))
+        fingerprints[name] = fingerprint.to_data()
+    with open(args.ref_data, "wb") as f:
+        pickle.dump(driver.ref_data, f)
+    print("Saved {} fingerprints".format(len(positives)))
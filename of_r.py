@@ -6,22 +6,8 @@ driver = ConfiguredDriver()
 try:
     while True:
         try:
-            driver.farm_map("OF-F3")
-
-            driver.refresh_screen()
-            obsidian_query = driver.query_set("of_r.maps.obsidian_count")
-            if not obsidian_query:
-                driver.goto_map("OF-6")
-                obsidian_query = driver.query_set("of_r.maps.obsidian_count")
-            obs_count = int(obsidian_query[0])
-            print("- Current Obsidian count: {}".format(obs_count))
-
-            if obs_count >= 1060:
-                farm_plan = ("OF-8", 1)
-            else:
-                farm_plan = ("OF-6", min(3, (1060 - obs_count)//28 + 1))
-            driver.farm_map(*farm_plan)
-            driver.exc_log.clear()
+            driver.run_plan("of_r")
+            break
         except UnexpectedState:
             exc = driver.recover_from_exc(sys.exc_info())
             if exc is not None:
@@ -30,4 +16,6 @@ try:
             else:
                 print("- Recovered")
 except KeyboardInterrupt:
-    pass
\ No newline at end of file
+    pass
+finally:
+    driver.close()
\ No newline at end of file
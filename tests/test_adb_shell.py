@@ -0,0 +1,58 @@
+import subprocess
+import pytest
+from ArkDriver.AdbShell import AdbShell, ShellCommandError
+
+# Stands in for an adb shell transport, running each line sent through a local sh
+class FakeTransport(object):
+    def __init__(self, lines):
+        self.lines = lines
+        self.conn = self
+        self.pending = b''
+
+    def send_command(self, cmd):
+        pass
+
+    def check_okay(self):
+        pass
+
+    def send(self, data):
+        line = data.decode("utf-8")
+        self.lines.append(line)
+        self.pending += subprocess.run(["sh", "-c", line], stdout=subprocess.PIPE).stdout
+
+    def recv(self, size):
+        chunk, self.pending = self.pending[:size], self.pending[size:]
+        return chunk
+
+    def close(self):
+        pass
+
+class FakeDevice(object):
+    serial = "fake"
+
+    def __init__(self):
+        self.lines = []
+
+    def open_transport(self):
+        return FakeTransport(self.lines)
+
+def test_run_returns_output():
+    shell = AdbShell(FakeDevice())
+    assert shell.run(["echo", "a b"]) == "a b\n"
+    assert shell.run("printf x") == "x"
+
+def test_run_raises_on_non_zero_status():
+    shell = AdbShell(FakeDevice())
+    with pytest.raises(ShellCommandError) as info:
+        shell.run("echo failed; (exit 3)")
+    assert info.value.status == 3
+    assert info.value.output == "failed\n"
+
+def test_run_batch_sends_one_line_and_stops_at_failure():
+    dev = FakeDevice()
+    shell = AdbShell(dev)
+    assert shell.run_batch([["echo", "a"], "echo b"], 0.01) == "a\nb\n"
+    assert len(dev.lines) == 1
+    with pytest.raises(ShellCommandError) as info:
+        shell.run_batch(["echo a", "false", "echo c"])
+    assert info.value.output == "a\n"
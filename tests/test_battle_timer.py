@@ -0,0 +1,39 @@
+from ArkDriver.BattleTimer import BattleTimer, BATTLE_HISTORY
+
+def test_without_history_checks_are_sparse():
+    timer = BattleTimer({})
+    assert timer.window("1-7") is None
+    assert timer.schedule("1-7", sparse=30, dense=5)(0) == 30
+
+def test_window_of_recent_durations():
+    stats = {}
+    timer = BattleTimer(stats)
+    for secs in range(100, 100 + BATTLE_HISTORY + 5):
+        timer.record("1-7", secs)
+    history = stats["battle_durations"]["1-7"]
+    assert len(history) == BATTLE_HISTORY and history[0] == 105
+    assert timer.window("1-7") == (105, 105 + int(0.9 * (BATTLE_HISTORY - 1)))
+
+def test_schedule_halves_the_wait_then_checks_densely():
+    timer = BattleTimer({})
+    for secs in (200, 210, 220):
+        timer.record("1-7", secs)
+    interval = timer.schedule("1-7", sparse=30, dense=5)
+    # Shortest 200 and 90th percentile 210 secs, with a lead of two dense checks: 190 to 220 secs
+    assert interval(0) == 95
+    assert interval(95) == 47.5
+    assert interval(170) == 20
+    assert interval(190) == 5
+    assert interval(219) == 5
+    assert interval(220) == 30
+
+def test_checks_land_in_the_window():
+    timer = BattleTimer({})
+    timer.record("1-7", 300)
+    interval = timer.schedule("1-7", sparse=30, dense=5)
+    elapsed, checks = 0, []
+    while elapsed < 300:
+        elapsed += interval(elapsed)
+        checks.append(elapsed)
+    assert checks[-1] - 300 <= 5
+    assert len(checks) < 20
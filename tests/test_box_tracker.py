@@ -0,0 +1,65 @@
+from ArkDriver.BoxTracker import BoxTracker
+
+CROP = (0, 0, 1000, 200)
+
+# Boxes of a scrolled list in screen coordinates, detect and full count their calls
+class Scene(object):
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.windows = []
+        self.full_calls = 0
+
+    def move(self, dx):
+        self.boxes = [(x + dx, y, w, h) for x, y, w, h in self.boxes]
+
+    def inside(self, window):
+        x0, y0, x1, y1 = window
+        return [b for b in self.boxes if b[0] >= x0 and b[1] >= y0 and b[0] + b[2] <= x1 and b[1] + b[3] <= y1]
+
+    def detect(self, window):
+        self.windows.append(window)
+        return self.inside(window)
+
+    def full(self):
+        self.full_calls += 1
+        return self.inside(CROP)
+
+def list_scene():
+    return Scene([(x, 50, 150, 100) for x in range(20, 2000, 250)])
+
+def track(tracker, scene, motion=(0, 0)):
+    return sorted(tracker.track(scene.detect, scene.full, CROP, motion))
+
+def test_follows_boxes_and_picks_up_revealed_ones():
+    scene = list_scene()
+    tracker = BoxTracker(margin=16, refresh=10)
+    assert track(tracker, scene) == scene.inside(CROP)
+    assert scene.full_calls == 1
+    scene.move(-300)
+    assert track(tracker, scene, (-300, 0)) == scene.inside(CROP)
+    assert scene.full_calls == 1
+    # Only windows around the moved boxes and the band revealed on the right are searched
+    assert sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in scene.windows) < 1000 * 200
+
+def test_unexpected_motion_falls_back_to_full_detection():
+    scene = list_scene()
+    tracker = BoxTracker(margin=16, refresh=10)
+    track(tracker, scene)
+    scene.move(-100)
+    assert track(tracker, scene, (0, 0)) == scene.inside(CROP)
+    assert scene.full_calls == 2
+
+def test_refresh_detects_the_whole_crop_periodically():
+    scene = list_scene()
+    tracker = BoxTracker(margin=16, refresh=3)
+    for _ in range(5):
+        track(tracker, scene)
+    assert scene.full_calls == 2
+
+def test_reset():
+    scene = list_scene()
+    tracker = BoxTracker()
+    track(tracker, scene)
+    tracker.reset()
+    track(tracker, scene)
+    assert scene.full_calls == 2
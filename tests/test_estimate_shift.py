@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+from ArkDriver.cvUtils import estimate_shift_cv
+
+WIDTH = 1280
+
+# Gray strip of a horizontal list of alike cards every period px, each with its own label, and blank past the end
+def list_strip(cards=12, period=300, seed=1):
+    rng = np.random.default_rng(seed)
+    strip = np.full((200, cards * period + 600), 40, np.uint8)
+    for i in range(cards):
+        x = i * period + 20
+        strip[20:180, x:x + 260] = 170
+        strip[40:60, x + 20:x + 20 + rng.integers(60, 200)] = 20
+        strip[100:160, x + 30:x + 230] = 120
+    return cv2.GaussianBlur(strip, (5, 5), 0)
+
+def view(strip, x):
+    return strip[:, x:x + WIDTH]
+
+def test_full_swipe():
+    strip = list_strip()
+    shift, _ = estimate_shift_cv(view(strip, 1000), view(strip, 1820), (-820, 0))
+    assert abs(shift[0] + 820) < 1 and abs(shift[1]) < 1
+
+def test_short_move_mid_list_is_not_a_card_multiple():
+    strip = list_strip()
+    shift, _ = estimate_shift_cv(view(strip, 1000), view(strip, 1300), (-820, 0))
+    assert abs(shift[0] + 300) < 1
+
+def test_list_end_stops_the_swipe_short():
+    strip = list_strip()
+    end = strip.shape[1] - WIDTH
+    shift, _ = estimate_shift_cv(view(strip, end - 220), view(strip, end), (-820, 0))
+    assert shift is not None and abs(shift[0] + 220) < 1
+
+def test_unrelated_frames_have_no_shift():
+    strip = list_strip()
+    other = np.random.default_rng(2).integers(0, 255, (200, WIDTH), dtype=np.uint8)
+    shift, _ = estimate_shift_cv(view(strip, 1000), other, (-820, 0))
+    assert shift is None
+
+def test_unchanged():
+    strip = list_strip()
+    assert estimate_shift_cv(view(strip, 1000), view(strip, 1000), (-820, 0)) == ((0, 0), 1.0)
@@ -0,0 +1,49 @@
+import random
+from time import sleep
+import pytest
+from ArkDriver.Driver import ArkDriver
+
+class FakeDev(object):
+    def get_geometry(self):
+        return (1280, 720)
+
+@pytest.fixture(params=[1, 4])
+def driver(request):
+    driver = ArkDriver(FakeDev())
+    driver.set_workers(request.param)
+    yield driver
+    driver.set_workers(1)
+
+def logged_square(driver):
+    def fn(n):
+        sleep(random.uniform(0, 0.01))
+        if n % 3:
+            driver.last_log = {"name": n}
+        return n * n
+    return fn
+
+def test_results_in_item_order(driver):
+    assert driver.map_parallel(logged_square(driver), range(20)) == [n * n for n in range(20)]
+
+def test_last_log_as_in_order(driver):
+    driver.last_log = {"name": "before"}
+    driver.map_parallel(logged_square(driver), range(10))
+    # 9 leaves no log, the last one left is 8's
+    assert driver.last_log == {"name": 8}
+    driver.last_log = {"name": "before"}
+    driver.map_parallel(logged_square(driver), [0, 3])
+    assert driver.last_log == {"name": "before"}
+
+def test_nested_calls_run_in_line(driver):
+    inner = lambda n: driver.map_parallel(lambda m: n * m, range(3))
+    assert driver.map_parallel(inner, range(4)) == [[n * m for m in range(3)] for n in range(4)]
+
+def test_deps_valid_stops_at_first_failure(driver):
+    def validate(name):
+        driver.last_log = {"name": name}
+        return name != "b"
+    driver.validate_component = validate
+    assert driver.deps_valid(["a", "b", "c"]) is False
+    assert driver.last_log == {"name": "b"}
+    assert driver.deps_valid(["a", "c"]) is True
+    assert driver.last_log == {"name": "c"}
@@ -0,0 +1,43 @@
+from ArkDriver.Navigator import Navigator, DEFAULT_EDGE_COST, EDGE_COST_EMA
+
+GRAPH = {"pages": {
+    "main": {"component": "main.settings", "edges": {"missions": "main.missions", "base": "main.base"}},
+    "menu_open": {"component": "menu.main", "priority": 1, "chain": True,
+        "edges": {"main": "menu.main", "base": "menu.base", "missions": "menu.missions"}},
+    "missions": {"component": "missions.inner", "edges": {"main": "back", "menu_open": "menu"}},
+    "base": {"component": "base.overview", "edges": {"main": "back", "menu_open": "menu"}},
+}}
+
+def test_route_follows_learned_costs():
+    stats = {}
+    nav = Navigator(GRAPH, stats)
+    nav.record("missions", "main", 1.0)
+    nav.record("main", "base", 1.0)
+    assert nav.route("missions", "base") == [("missions", "main", "back"), ("main", "base", "main.base")]
+    nav.record("missions", "main", 50.0)
+    assert nav.route("missions", "base") == [("missions", "menu_open", "menu"), ("menu_open", "base", "menu.base")]
+    assert stats["edge_costs"][("missions", "main")] > 2 * DEFAULT_EDGE_COST
+
+def test_record_is_an_ema():
+    nav = Navigator(GRAPH, {})
+    assert nav.cost("main", "base") == DEFAULT_EDGE_COST
+    nav.record("main", "base", 4.0)
+    nav.record("main", "base", 14.0)
+    assert nav.cost("main", "base") == 4.0 + EDGE_COST_EMA * (14.0 - 4.0)
+
+def test_route_edge_cases():
+    nav = Navigator(GRAPH, {})
+    assert nav.route("main", "main") == []
+    assert nav.route("main", "unknown") is None
+    assert nav.route(None, "main") is None
+
+def test_page_of_prefers_priority():
+    nav = Navigator(GRAPH, {})
+    assert nav.page_of({"main.settings", "menu.main"}) == "menu_open"
+    assert nav.page_of({"base.overview"}) == "base"
+    assert nav.page_of(set()) is None
+
+def test_chains_end_at_pages_without_chain():
+    nav = Navigator(GRAPH, {})
+    route = [("missions", "menu_open", "menu"), ("menu_open", "base", "menu.base"), ("base", "main", "back")]
+    assert nav.chains(route) == [route[:2], route[2:]]
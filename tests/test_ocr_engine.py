@@ -0,0 +1,45 @@
+import numpy as np
+from PIL import Image
+import ArkDriver.OcrEngine as OcrEngine
+
+def image_text(image):
+    return str(int((np.array(image) < 128).sum()))
+
+# Stands in for pytesseract, recording each tesseract run. trailing: the separator also follows the last page
+def fake_tesseract(calls, trailing=False):
+    def image_to_string(image, lang=None, config=None):
+        calls.append((image, config))
+        if not isinstance(image, str):
+            return image_text(image) + "\n"
+        with open(image) as f:
+            pages = [image_text(Image.open(fn)) + "\n" for fn in f.read().split()]
+        return "\f".join(pages) + ("\f" if trailing else "")
+    return image_to_string
+
+def binaries(*counts):
+    images = []
+    for count in counts:
+        image = np.full((20, 40), 255, np.uint8)
+        image.reshape(-1)[:count] = 0
+        images.append(image)
+    return images
+
+def test_batch_is_one_tesseract_run_with_the_config(monkeypatch):
+    for trailing in (False, True):
+        calls = []
+        monkeypatch.setattr(OcrEngine, "PyTessBaseAPI", None)
+        monkeypatch.setattr(OcrEngine, "image_to_string", fake_tesseract(calls, trailing))
+        texts = OcrEngine.OcrEngine().recognize_batch(binaries(3, 0, 17), config="--psm 7")
+        assert texts == ["3", "0", "17"]
+        assert len(calls) == 1
+        assert calls[0][1] == "--psm 7"
+
+def test_batch_reads_images_alone_when_pages_do_not_match(monkeypatch):
+    calls = []
+    run = fake_tesseract(calls)
+    monkeypatch.setattr(OcrEngine, "PyTessBaseAPI", None)
+    monkeypatch.setattr(OcrEngine, "image_to_string",
+        lambda image, lang=None, config=None: "merged" if isinstance(image, str) else run(image, lang, config))
+    texts = OcrEngine.OcrEngine().recognize_batch(binaries(3, 5), config="--psm 7")
+    assert texts == ["3", "5"]
+    assert len(calls) == 2
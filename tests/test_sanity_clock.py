@@ -0,0 +1,36 @@
+from ArkDriver.SanityClock import SanityClock, SANITY_REGEN_SECS
+
+def test_regenerates_one_point_per_period():
+    clock = SanityClock()
+    assert clock.value(0) is None
+    clock.read(10, 135, ts=0)
+    assert clock.value(SANITY_REGEN_SECS - 1) == 10
+    assert clock.value(SANITY_REGEN_SECS) == 11
+    assert clock.ready_at(30) == 20 * SANITY_REGEN_SECS
+
+def test_stops_at_max():
+    clock = SanityClock()
+    clock.read(130, 135, ts=0)
+    assert clock.value(100 * SANITY_REGEN_SECS) == 135
+    assert clock.ready_at(136) is None
+
+def test_spend_counts_regenerated_points_once():
+    clock = SanityClock()
+    clock.read(10, 135, ts=0)
+    clock.spend(5, ts=3600)
+    assert clock.value(3600) == 15
+    assert clock.ready_at(30) == 9000
+
+def test_spend_keeps_phase():
+    clock = SanityClock()
+    clock.read(10, 135, ts=0)
+    clock.spend(5, ts=3700)
+    assert clock.value(3959) == 15
+    assert clock.value(3960) == 16
+
+def test_spend_from_max_restarts_regeneration():
+    clock = SanityClock()
+    clock.read(135, 135, ts=0)
+    clock.spend(30, ts=1000)
+    assert clock.value(1000 + SANITY_REGEN_SECS - 1) == 105
+    assert clock.value(1000 + SANITY_REGEN_SECS) == 106
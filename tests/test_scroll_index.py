@@ -0,0 +1,58 @@
+import numpy as np
+from ArkDriver.ScrollIndex import ScrollIndex, jump_swipes
+
+def pixels(value):
+    return np.full((20, 40), value, np.uint8)
+
+def test_lookup_follows_the_list_across_moves():
+    index = ScrollIndex(tolerance=10, max_diff=12.0)
+    index.add((600, 300, 200, 80), pixels(100), ["OF-3"])
+    # The content moved 250 px to the left, the entry is now at 350 on screen
+    index.move((-250, 0))
+    assert index.position((350, 300)) == (600, 300)
+    assert index.lookup((354, 296, 200, 80), pixels(105)) == ["OF-3"]
+    assert index.lookup((380, 300, 200, 80), pixels(100)) is None
+
+def test_lookup_needs_matching_pixels():
+    index = ScrollIndex(tolerance=10, max_diff=12.0)
+    index.add((600, 300, 200, 80), pixels(100), ["OF-3"])
+    assert index.lookup((600, 300, 200, 80), pixels(140)) is None
+    assert index.lookup((600, 300, 200, 80), np.full((20, 30), 100, np.uint8)) is None
+
+def test_reset_starts_a_new_segment():
+    index = ScrollIndex()
+    index.add((600, 300, 200, 80), pixels(100), ["OF-3"])
+    index.move((-250, 0))
+    index.reset()
+    assert index.lookup((600, 300, 200, 80), pixels(100)) is None
+    index.add((100, 300, 200, 80), pixels(50), ["OF-7"])
+    assert index.stitched() == [((100, 300), ["OF-7"])]
+
+def test_stitched_in_list_order():
+    index = ScrollIndex()
+    index.add((600, 300, 200, 80), pixels(100), ["OF-2"])
+    index.move((-500, 0))
+    index.add((400, 300, 200, 80), pixels(120), ["OF-3"])
+    index.add((50, 300, 200, 80), pixels(110), ["OF-1"])
+    assert index.stitched() == [((550, 300), ["OF-1"]), ((600, 300), ["OF-2"]), ((900, 300), ["OF-3"])]
+
+CROP = (0, 200, 1280, 440)
+NEXT_SWIPE = (1000, 360, -600, 0, 1500)
+
+def test_jump_centers_the_position_in_crop():
+    swipes = jump_swipes(CROP, (2000, 300), NEXT_SWIPE)
+    assert sum(dx for _, _, dx, _, _ in swipes) == 640 - 2000
+    assert all(dy == 0 for _, _, _, dy, _ in swipes)
+
+def test_jump_swipes_cross_the_crop_at_the_swipe_speed():
+    margin = 1280 // 20
+    swipes = jump_swipes(CROP, (5000, 300), NEXT_SWIPE)
+    assert len(swipes) == 4
+    for x, y, dx, dy, t in swipes:
+        assert x == 1280 - margin and y == 360
+        assert x + dx >= margin
+        assert t == round(1500 * abs(dx) / 600)
+
+def test_no_jump_against_the_scroll_direction():
+    assert jump_swipes(CROP, (640, 300), NEXT_SWIPE) == []
+    assert jump_swipes(CROP, (300, 300), NEXT_SWIPE) == []